@@ -0,0 +1,1281 @@
+"""Бенчмарки горячих участков бота, не требующие аккаунта Telegram.
+
+Запуск:
+    python benchmark.py              # все бенчмарки
+    python benchmark.py accumulator  # только выбранный
+
+Нагрузочный прогон (load) настраивается переменными окружения:
+    BENCH_CORPUS=1000,100000,1000000   размеры синтетических корпусов каналов
+    BENCH_TELEGRAM_LATENCY=0.2         средняя задержка ответа Telegram (сек)
+    BENCH_API_LATENCY=0.02             задержка Bot API (сек)
+    BENCH_FLOOD_RATE=0.01              доля запросов, на которые Telegram отвечает FloodWait
+    BENCH_FLOOD_SECONDS=2              длительность FloodWait (сек)
+    BENCH_USERS=50                     одновременных пользователей
+    BENCH_ROUNDS=3                     поисков на пользователя
+
+Бюджеты нагрузочного прогона (не заданы - не проверяются); при превышении любого из них
+benchmark.py завершается с ненулевым кодом:
+    BENCH_MAX_P95_MS=1500              p95 поиска с показом первой страницы (мс)
+    BENCH_MAX_CLICK_P95_MS=100         p95 листания (мс)
+    BENCH_MAX_CALLS_PER_SEARCH=10      запросов к Telegram на один поиск
+"""
+import os
+import sys
+import gc
+import time
+import random
+import itertools
+import string
+import json
+import io
+import csv
+import socket
+import subprocess
+import asyncio
+import logging
+from types import SimpleNamespace
+
+# Бенчмарки не должны трогать рабочую базу бота и зависеть от настроек в .env
+os.environ['DB_PATH'] = ':memory:'
+os.environ['MAX_RESULTS'] = '100'
+
+import bot
+from bot import ResultAccumulator, RelevanceScorer, SynonymIndex
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.types import InputChannel
+from telegram import InputFile
+
+logging.getLogger('bot').setLevel(logging.ERROR)
+
+
+# Синтетический канал с заданным юзернеймом
+def make_channel(username, participants_count=0):
+    return {
+        'title': f'Канал {username}',
+        'username': username,
+        'link': f'https://t.me/{username}',
+        'description': 'Нет описания',
+        'participants_count': participants_count
+    }
+
+
+# Синтетический поток находок: каждый канал встречается в среднем дважды
+def make_sightings(count):
+    rng = random.Random(count)
+    usernames = [''.join(rng.choices(string.ascii_lowercase, k=12)) for _ in range(count)]
+    sightings = [make_channel(name, rng.randint(0, 10 ** 6)) for name in usernames]
+    sightings += [make_channel(name.upper(), rng.randint(0, 10 ** 6)) for name in rng.sample(usernames, count)]
+    rng.shuffle(sightings)
+    return [(channel, rng.random() < 0.3) for channel in sightings]
+
+
+# Прежняя сборка результатов: линейная проверка дубликатов и вставка в начало списка
+def legacy_assemble(sightings):
+    results = []
+    for channel, matched in sightings:
+        if not any(r['username'].lower() == channel['username'].lower() for r in results):
+            if matched:
+                results.insert(0, channel)
+            else:
+                results.append(channel)
+    return results
+
+
+def accumulator_assemble(sightings):
+    results = ResultAccumulator()
+    for channel, matched in sightings:
+        results.add(channel, matched=matched)
+    return results.results()
+
+
+def bench_accumulator():
+    """Стоимость одной вставки в зависимости от размера результата"""
+    print('Сборка результатов: мкс на одну находку')
+    print(f'{"каналов":>10} {"список":>12} {"накопитель":>12}')
+    for count in (1000, 5000, 10000, 50000, 100000):
+        sightings = make_sightings(count)
+
+        legacy = '-'
+        # Квадратичный вариант на больших объёмах выполняется минутами
+        if count <= 10000:
+            started = time.perf_counter()
+            legacy_assemble(sightings)
+            legacy = f'{(time.perf_counter() - started) / len(sightings) * 1e6:.2f}'
+
+        started = time.perf_counter()
+        accumulator_assemble(sightings)
+        current = f'{(time.perf_counter() - started) / len(sightings) * 1e6:.2f}'
+        print(f'{count:>10} {legacy:>12} {current:>12}')
+
+
+def bench_synonyms():
+    """Стоимость поиска синонимов в зависимости от размера словаря"""
+    rng = random.Random(7)
+    words = ['спортивные новости', 'криптовалюта', 'xq', 'несуществующее', 'music']
+    print('Поиск синонимов: мкс на один запрос')
+    print(f'{"ключей":>10} {"индекс":>12}')
+    for size in (20, 1000, 5000, 20000):
+        table = {
+            ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 12))): ['a', 'b', 'c']
+            for _ in range(size)
+        }
+        table.update({'новости': ['news'], 'спорт': ['sport'], 'крипто': ['crypto']})
+        index = SynonymIndex(table)
+        rounds = 2000
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for word in words:
+                index.lookup(word)
+        elapsed = (time.perf_counter() - started) / (rounds * len(words)) * 1e6
+        print(f'{size:>10} {elapsed:>12.2f}')
+
+
+# Синтетический корпус каналов со словами из популярных тематик
+def make_corpus(count, seed=1):
+    rng = random.Random(seed)
+    words = ['новости', 'крипто', 'спорт', 'музыка', 'игры', 'tech', 'news', 'daily', 'мир', 'бизнес',
+             'кино', 'юмор', 'авто', 'путешествия', 'рецепты', 'наука', 'it', 'дизайн', 'финансы', 'мода']
+    corpus = []
+    for i in range(count):
+        title = ' '.join(rng.sample(words, 3)).capitalize()
+        username = f'{rng.choice(words)}_{i}'
+        description = ' '.join(rng.sample(words, 5)) if rng.random() < 0.5 else 'Нет описания'
+        corpus.append({
+            'title': title,
+            'username': username,
+            'link': f'https://t.me/{username}',
+            'description': description,
+            'participants_count': int(rng.paretovariate(1.2) * 100)
+        })
+    return corpus
+
+
+# Прежняя проверка релевантности: вложенные циклы по каналам и терминам
+def legacy_relevance(channels, search_terms):
+    matched = []
+    for channel in channels:
+        title_lower = channel['title'].lower()
+        username_lower = channel['username'].lower()
+        about_lower = channel['description'].lower()
+        match_found = False
+        for term in search_terms:
+            term_lower = term.lower()
+            if term_lower in title_lower or term_lower in username_lower or term_lower in about_lower:
+                match_found = True
+                break
+        matched.append(match_found)
+    return matched
+
+
+def bench_scoring():
+    """Оценка и ранжирование 100k синтетических каналов"""
+    corpus = make_corpus(100000)
+    search_terms = ['Новости', 'крипто', 'IT']
+    print(f'Ранжирование {len(corpus)} каналов по терминам {search_terms}')
+
+    started = time.perf_counter()
+    legacy_relevance(corpus, search_terms)
+    print(f'{"бинарная проверка (старая)":<32} {(time.perf_counter() - started) * 1000:>10.1f} мс')
+
+    scorer = RelevanceScorer(search_terms)
+    started = time.perf_counter()
+    matches = scorer.matches(corpus)
+    print(f'{"проверка совпадений (да/нет)":<32} {(time.perf_counter() - started) * 1000:>10.1f} мс')
+
+    started = time.perf_counter()
+    term_scores = scorer.term_scores(corpus)
+    print(f'{"совпадения терминов (пачкой)":<32} {(time.perf_counter() - started) * 1000:>10.1f} мс')
+    if matches != [term_score > 0 for term_score in term_scores]:
+        FAILURES.append('scoring: matches() расходится с term_scores()')
+        print('ОШИБКА: matches() расходится с term_scores()')
+
+    started = time.perf_counter()
+    ranked = scorer.rank(corpus)
+    print(f'{"оценка и сортировка":<32} {(time.perf_counter() - started) * 1000:>10.1f} мс')
+    print(f'Лучший результат: {ranked[0]["title"]} (@{ranked[0]["username"]})')
+
+
+# Имитация клиента Telethon: задержка ответа и случайные FloodWait
+class FakeTelegramClient:
+    def __init__(self, corpus, latency=0.3, flood_rate=0.0, flood_seconds=30, seed=0, search_counts=True,
+                 page_limit=100):
+        self.latency = latency
+        # Сколько каналов глобальный поиск отдает на один запрос, независимо от limit
+        self.page_limit = page_limit
+        # Глобальный поиск часто не возвращает число подписчиков - его дает только GetFullChannelRequest
+        self.search_counts = search_counts
+        self.by_username = {channel['username']: channel for channel in corpus}
+        # Идентификаторы каналов для InputChannel; access_hash у каждого аккаунта свой
+        self.ids = {channel['username']: channel_id for channel_id, channel in enumerate(corpus, 1)}
+        self.by_id = {channel_id: channel for channel_id, channel in enumerate(corpus, 1)}
+        self.salt = seed + 1
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.by_word = {}
+        for channel in corpus:
+            for word in channel['title'].lower().split():
+                self.by_word.setdefault(word, []).append(channel)
+
+    def is_connected(self):
+        return True
+
+    async def is_user_authorized(self):
+        return True
+
+    def add_event_handler(self, *args, **kwargs):
+        pass
+
+    async def iter_dialogs(self):
+        return
+        yield
+
+    async def __call__(self, request, **kwargs):
+        self.calls += 1
+        # Логнормальная задержка даёт реалистичный «хвост» медленных ответов
+        await asyncio.sleep(self.latency * self.rng.lognormvariate(0, 0.6))
+        if self.rng.random() < self.flood_rate:
+            raise FloodWaitError(None, capture=self.flood_seconds)
+        if isinstance(request, GetFullChannelRequest):
+            # Юзернейм вместо InputChannel стоил бы скрытого ResolveUsername
+            if not isinstance(request.channel, InputChannel):
+                raise TypeError(f'GetFullChannelRequest по юзернейму: {request.channel}')
+            if request.channel.access_hash != request.channel.channel_id * self.salt:
+                raise ValueError('CHANNEL_INVALID: access_hash другого аккаунта')
+            channel = self.by_id[request.channel.channel_id]
+            return SimpleNamespace(
+                full_chat=SimpleNamespace(
+                    id=request.channel.channel_id, participants_count=channel['participants_count'],
+                    about='' if channel['description'] == 'Нет описания' else channel['description']
+                ),
+                chats=[SimpleNamespace(id=request.channel.channel_id, title=channel['title'])]
+            )
+        # Запрос из нескольких слов: первое слово целиком, остальные - начала слов названия
+        first, *prefixes = request.q.split()
+        found = (
+            channel for channel in self.by_word.get(first, [])
+            if all(any(word.startswith(prefix) for word in channel['title'].lower().split()) for prefix in prefixes)
+        )
+        chats = [
+            SimpleNamespace(
+                broadcast=True, username=channel['username'], title=channel['title'],
+                id=self.ids[channel['username']], access_hash=self.ids[channel['username']] * self.salt,
+                participants_count=channel['participants_count'] if self.search_counts else None
+            )
+            for channel in itertools.islice(found, min(request.limit, self.page_limit))
+        ]
+        return SimpleNamespace(chats=chats)
+
+
+# Имитация Bot API: сообщения получают идентификаторы, вызовы считаются
+class FakeBot:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.edits = 0
+        self.documents = []
+        self.next_message_id = 1
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+        await self._call()
+        message = FakeMessage(self, chat_id, self.next_message_id)
+        self.next_message_id += 1
+        return message
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, parse_mode=None):
+        await self._call()
+        self.edits += 1
+        return True
+
+    async def delete_message(self, chat_id, message_id):
+        await self._call()
+        return True
+
+    async def send_chat_action(self, chat_id, action):
+        await self._call()
+        return True
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, message_id, text=''):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+
+    async def reply_html(self, text, reply_markup=None):
+        return await self.bot.send_message(self.chat_id, text, reply_markup=reply_markup, parse_mode='HTML')
+
+    async def reply_document(self, document, filename=None, caption=None):
+        # Как и настоящий запрос PTB: InputFile читает документ в память целиком, это входит в пик выгрузки
+        content = InputFile(document, filename=filename).input_file_content
+        self.bot.documents.append((filename, len(content)))
+        return await self.bot.send_message(self.chat_id, caption)
+
+
+# Апдейт с текстовым сообщением пользователя и контекст обработчика
+def make_message_update(fake_bot, user_id, text):
+    message = FakeMessage(fake_bot, user_id, 0, text)
+    update = SimpleNamespace(
+        message=message, callback_query=None,
+        effective_chat=SimpleNamespace(id=user_id),
+        effective_user=SimpleNamespace(id=user_id)
+    )
+    context = SimpleNamespace(bot=fake_bot, user_data={})
+    return update, context
+
+
+# Подмена клиентов Telethon на имитацию; объекты, привязанные к прежнему циклу событий, сбрасываются
+def use_fake_accounts(accounts):
+    async def fake_client(phone_number):
+        return accounts[phone_number]
+
+    bot.get_telethon_client = fake_client
+    bot.ADMIN_PHONE = next(iter(accounts))
+    bot.SEARCH_PHONE_NUMBERS = list(accounts)
+    # В боте пул подключает on_startup; имитации уже подключены и авторизованы
+    bot.CLIENT_POOL = bot.ClientPool(list(accounts))
+    for account in bot.CLIENT_POOL.accounts:
+        account.client, account.authorized = accounts[account.phone_number], True
+    bot.DIALOG_SNAPSHOT = None
+
+
+# Чистая база в памяти: пустые кэш и индекс каналов
+def reset_storage():
+    bot.DB = None
+    bot.SEARCH_CACHE = None
+    bot.CHANNEL_INDEX = None
+    bot.SESSION_STORE = None
+    bot.CHANNEL_ENRICHER = None
+    bot.CATEGORY_CRAWLER = None
+    bot.TERM_ALIASES.clear()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench_deadline():
+    """Нагрузочный тест поиска: задержки латентности при лимите времени SEARCH_DEADLINE"""
+    corpus = make_corpus(20000)
+    accounts = {f'+{i}': FakeTelegramClient(corpus, latency=0.4, flood_rate=0.01, flood_seconds=3, seed=i) for i in range(2)}
+
+    use_fake_accounts(accounts)
+    reset_storage()
+    saved = bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH
+    bot.SEARCH_CACHE_TTL = 0
+    bot.LOCAL_INDEX_ENOUGH = 10 ** 9
+    queries = [['новости'], ['крипто', 'бизнес'], ['спорт', 'игры'], ['музыка'], ['tech', 'наука']]
+
+    async def run():
+        latencies = []
+        partial = 0
+        semaphore = asyncio.Semaphore(10)
+
+        async def one(query):
+            nonlocal partial
+            async with semaphore:
+                started = time.perf_counter()
+                results = await bot.search_channels(query, bot.ADMIN_PHONE)
+                latencies.append(time.perf_counter() - started)
+                partial += getattr(results, 'partial', False)
+
+        await asyncio.gather(*(one(queries[i % len(queries)]) for i in range(100)))
+        return latencies, partial
+
+    # Без ограничения числа результатов локальный индекс не заменяет глобальный поиск
+    max_results = bot.MAX_RESULTS
+    bot.MAX_RESULTS = 10 ** 6
+    try:
+        latencies, partial = asyncio.run(run())
+    finally:
+        bot.MAX_RESULTS = max_results
+        bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH = saved
+    calls = sum(client.calls for client in accounts.values())
+    print(f'Поиск со SEARCH_DEADLINE={bot.SEARCH_DEADLINE} сек, 100 запросов по 10 одновременно')
+    print(f'p50 {percentile(latencies, 50):.2f} сек, p95 {percentile(latencies, 95):.2f} сек, '
+          f'макс {max(latencies):.2f} сек')
+    print(f'Частичных результатов: {partial}, запросов к API: {calls}')
+
+
+def bench_handlers():
+    """Пропускная способность обработчика поиска при одновременных апдейтах"""
+    reset_storage()
+    client = FakeTelegramClient(make_corpus(20000), latency=0.05)
+    queries = ['новости', 'крипто', 'спорт', 'музыка', 'tech', 'наука, кино', 'авто', 'юмор']
+
+    async def run(count):
+        use_fake_accounts({'+0': client})
+        fake_bot = FakeBot(latency=0.01)
+        latencies = []
+
+        async def one(i):
+            update, context = make_message_update(fake_bot, i, queries[i % len(queries)])
+            started = time.perf_counter()
+            await bot.get_search_terms(update, context)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(count)))
+        return count / (time.perf_counter() - started), latencies
+
+    def report(label):
+        throughput, latencies = asyncio.run(run(500))
+        print(f'{label:<28} {throughput:>8.0f} обработчиков/сек, p95 {percentile(latencies, 95) * 1000:.0f} мс')
+
+    if os.getenv('BENCH_NEST_ASYNCIO'):
+        # Дочерний процесс сравнения: nest_asyncio меняет asyncio всего процесса, и это не отменить
+        import nest_asyncio
+        nest_asyncio.apply()
+        asyncio.run(run(len(queries)))
+        report('с nest_asyncio')
+        return
+
+    print('500 одновременных поисков (кэш прогрет, общий цикл событий)')
+    asyncio.run(run(len(queries)))
+    report('один цикл событий')
+    try:
+        import nest_asyncio
+    except ImportError:
+        return
+    # Для сравнения - прежний режим с повторно входимым циклом событий, в отдельном процессе,
+    # чтобы следующие бенчмарки шли на обычном asyncio
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), 'handlers'],
+        env=dict(os.environ, BENCH_NEST_ASYNCIO='1'), capture_output=True, text=True
+    )
+    print(result.stdout.strip() if result.returncode == 0 else f'с nest_asyncio: ошибка\n{result.stderr.strip()}')
+
+
+def bench_enrichment():
+    """Фоновое дополнение: поиск не ждет GetFullChannelRequest, числа подписчиков появляются на следующих показах"""
+    corpus = make_corpus(20000)
+    # У каждого аккаунта свои access_hash: канал дополняется через тот аккаунт, который его нашел
+    clients = [FakeTelegramClient(corpus, latency=0.1, search_counts=False, seed=i) for i in range(2)]
+
+    def total_calls():
+        return sum(client.calls for client in clients)
+
+    async def run():
+        reset_storage()
+        use_fake_accounts({f'+{i}': client for i, client in enumerate(clients)})
+        enricher = bot.get_channel_enricher()
+        enricher.start(bot.get_client_pool())
+        fake_bot = FakeBot()
+        update, context = make_message_update(fake_bot, 1, 'новости')
+
+        started = time.perf_counter()
+        await bot.get_search_terms(update, context)
+        searched = time.perf_counter() - started
+        session = bot.get_session_store().get(1)
+        unknown = sum(not record.participants_count for record in session.results)
+        calls_before = total_calls()
+
+        while enricher.queue or enricher.queued:
+            await asyncio.sleep(0.05)
+        enriched = time.perf_counter() - started - searched
+        session = bot.get_session_store().get(1)
+        text = bot.render_detailed_page(session)[0]
+        await enricher.stop()
+        return searched, enriched, len(session.results), unknown, total_calls() - calls_before, text.count('Неизвестно')
+
+    searched, enriched, total, unknown, calls, still_unknown = asyncio.run(run())
+    print(f'Поиск: {searched * 1000:.0f} мс, каналов {total}, без числа подписчиков {unknown}')
+    print(f'Дополнение в фоне: {enriched * 1000:.0f} мс, запросов GetFullChannelRequest {calls}, '
+          f'«Неизвестно» на странице подробностей после дополнения: {still_unknown}')
+
+
+def bench_sessions():
+    """Память на 10 000 одновременных сессий: словари в user_data против общих записей SessionStore"""
+    import tracemalloc
+
+    corpus = make_corpus(50000)
+    rng = random.Random(7)
+    picks = [rng.sample(range(len(corpus)), 100) for _ in range(10000)]
+
+    def measure(build):
+        tracemalloc.start()
+        kept = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size, kept
+
+    # Прежняя схема: каждый поиск создает собственные словари каналов со ссылками
+    legacy_size, _ = measure(lambda: [
+        {'search_results': [{**corpus[i], 'link': f'https://t.me/{corpus[i]["username"]}'} for i in pick], 'buttons_page': 0}
+        for pick in picks
+    ])
+
+    reset_storage()
+    store = bot.get_session_store()
+
+    def build_store():
+        for user_id, pick in enumerate(picks):
+            store.set_results(store.create(user_id, ['новости']), [corpus[i] for i in pick])
+        return store
+
+    store_size, _ = measure(build_store)
+    print('10 000 сессий по 100 каналов из корпуса 50 000')
+    print(f'{"словари в user_data":<24} {legacy_size / 2 ** 20:>7.1f} МБ')
+    print(f'{"SessionStore":<24} {store_size / 2 ** 20:>7.1f} МБ')
+
+    started = time.perf_counter()
+    for session in list(store.sessions.values()):
+        store.save(session)
+    saved = time.perf_counter() - started
+    store.sessions.clear()
+    started = time.perf_counter()
+    for user_id in range(len(picks)):
+        store.get(user_id)
+    loaded = time.perf_counter() - started
+    print(f'сохранение {saved * 1e6 / len(picks):.0f} мкс/сессия, чтение с диска {loaded * 1e6 / len(picks):.0f} мкс/сессия')
+
+
+def bench_pagination():
+    """Стоимость нажатия кнопок листания: сборка страницы заново против готовой страницы из кэша сессии"""
+    reset_storage()
+    store = bot.get_session_store()
+    session = store.create(1, ['новости'])
+    store.set_results(session, make_corpus(600))
+    pages = (len(session.results) + bot.CHANNELS_PER_PAGE - 1) // bot.CHANNELS_PER_PAGE
+
+    def render_all(cold):
+        started = time.perf_counter()
+        for page in range(pages):
+            session.page = page
+            if cold:
+                session.renders.clear()
+            bot.render_channels_page(session)
+            bot.render_detailed_page(session)
+        return (time.perf_counter() - started) * 1e6 / pages
+
+    print(f'Сборка страницы списка и подробностей ({pages} страниц)')
+    print(f'{"каждый раз заново":<22} {render_all(True):>8.1f} мкс')
+    render_all(False)
+    print(f'{"из кэша":<22} {render_all(False):>8.1f} мкс')
+
+    # Нажатия «Вперёд» на последней странице и повторные «Подробнее» не должны вызывать edit_message_text
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot, user_data={})
+
+    async def click(data, times):
+        for _ in range(times):
+            await bot.handle_pagination(make_callback_update(fake_bot, 1, data), context)
+
+    session.page = pages - 1
+    session.shown = None
+    edits_before = fake_bot.edits
+    asyncio.run(click('next_page', 100))
+    asyncio.run(click('detailed_view', 100))
+    print(f'100 × «Вперёд» на последней странице и 100 × «Подробнее»: '
+          f'{fake_bot.edits - edits_before} вызовов edit_message_text (ожидается 2 - по одному на смену вида)')
+
+
+# Нажатие кнопки под сообщением с результатами
+class FakeCallbackQuery:
+    def __init__(self, fake_bot, user_id, data):
+        self.bot = fake_bot
+        self.data = data
+        self.message = FakeMessage(fake_bot, user_id, 1)
+
+    async def answer(self):
+        await self.bot._call()
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        return await self.bot.edit_message_text(
+            text, chat_id=self.message.chat_id, message_id=self.message.message_id,
+            reply_markup=reply_markup, parse_mode=parse_mode
+        )
+
+
+def make_callback_update(fake_bot, user_id, data):
+    return SimpleNamespace(
+        message=None, callback_query=FakeCallbackQuery(fake_bot, user_id, data),
+        effective_chat=SimpleNamespace(id=user_id),
+        effective_user=SimpleNamespace(id=user_id)
+    )
+
+
+def bench_updates():
+    """Задержка листания страниц, пока у других пользователей (и у самого листающего) идут холодные поиски"""
+    from telegram.ext import SimpleUpdateProcessor
+
+    corpus = make_corpus(20000)
+    words = ['новости', 'крипто', 'спорт', 'музыка', 'игры', 'tech', 'news', 'daily', 'мир', 'бизнес',
+             'кино', 'юмор', 'авто', 'путешествия', 'рецепты', 'наука', 'it', 'дизайн', 'финансы', 'мода']
+    results = [make_channel(f'channel_{i}', i) for i in range(60)]
+
+    async def run(processor, users=len(words), clicks=5):
+        reset_storage()
+        use_fake_accounts({'+0': FakeTelegramClient(corpus, latency=0.3)})
+        fake_bot = FakeBot(latency=0.01)
+        latencies = []
+
+        async def search(user_id):
+            update, context = make_message_update(fake_bot, user_id, words[user_id])
+            await processor.process_update(update, bot.get_search_terms(update, context))
+
+        # Листает прошлые результаты; половина листающих в это же время ищет что-то новое
+        async def browse(user_id):
+            store = bot.get_session_store()
+            store.set_results(store.create(user_id, ['архив']), results)
+            context = SimpleNamespace(bot=fake_bot, user_data={})
+            for _ in range(clicks):
+                update = make_callback_update(fake_bot, user_id, 'next_page')
+                started = time.perf_counter()
+                await processor.process_update(update, bot.handle_pagination(update, context))
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0.2)
+
+        started = time.perf_counter()
+        async with processor:
+            await asyncio.gather(
+                *(search(user_id) for user_id in range(users)),
+                *(browse(user_id) for user_id in range(users // 2, users + users // 2))
+            )
+        return time.perf_counter() - started, latencies
+
+    print(f'{len(words)} холодных поисков и {len(words)} листающих пользователей по 5 нажатий')
+    for label, processor in (
+        ('последовательно', SimpleUpdateProcessor(1)),
+        ('по очереди на пользователя', bot.PerUserUpdateProcessor(bot.UPDATE_CONCURRENCY)),
+    ):
+        elapsed, latencies = asyncio.run(run(processor))
+        print(f'{label:<28} всего {elapsed:>5.1f} с, нажатие p50 {percentile(latencies, 50) * 1000:>6.0f} мс, '
+              f'p95 {percentile(latencies, 95) * 1000:>6.0f} мс')
+
+    # Один пользователь отправляет сообщения подряд, пока другой листает: очередь первого
+    # не должна занимать общие слоты обработки
+    async def flood(slots, messages=12, clicks=5):
+        reset_storage()
+        use_fake_accounts({'+0': FakeTelegramClient(corpus, latency=0.3)})
+        fake_bot = FakeBot(latency=0.01)
+        processor = bot.PerUserUpdateProcessor(slots)
+        latencies = []
+
+        async def send(i):
+            update, context = make_message_update(fake_bot, 1, words[i % len(words)])
+            await processor.process_update(update, bot.get_search_terms(update, context))
+
+        async def browse():
+            store = bot.get_session_store()
+            store.set_results(store.create(2, ['архив']), results)
+            context = SimpleNamespace(bot=fake_bot, user_data={})
+            await asyncio.sleep(0.05)
+            for _ in range(clicks):
+                update = make_callback_update(fake_bot, 2, 'next_page')
+                started = time.perf_counter()
+                await processor.process_update(update, bot.handle_pagination(update, context))
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0.1)
+
+        async with processor:
+            await asyncio.gather(*(send(i) for i in range(messages)), browse())
+        return latencies
+
+    latencies = asyncio.run(flood(4))
+    print(f'12 сообщений одного пользователя подряд, 4 слота: нажатия другого пользователя '
+          f'p50 {percentile(latencies, 50) * 1000:.0f} мс, макс {max(latencies) * 1000:.0f} мс')
+
+
+class TooManyRequests(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+# Имитация HTTP-сервера Bot API: отвечает на методы, которые вызывает бот, и фиксирует ответы пользователям
+class FakeBotApi:
+    def __init__(self, latency=0.0, global_limit=None, chat_limit=None):
+        self.latency = latency
+        self.next_message_id = 1
+        self.waiters = {}
+        # Лимиты Telegram: не больше global_limit сообщений за секунду всего и chat_limit - в один чат
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.sent = []
+        self.sent_by_chat = {}
+        self.calls = {}
+        self.rejected = 0
+
+    def wait_reply(self, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = future
+        return future
+
+    def message(self, chat_id, text):
+        self.next_message_id += 1
+        return {
+            'message_id': self.next_message_id, 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'text': text
+        }
+
+    def over_limit(self, chat_id):
+        now = time.monotonic()
+        self.sent = [t for t in self.sent if now - t < 1]
+        chat_sent = self.sent_by_chat[chat_id] = [t for t in self.sent_by_chat.get(chat_id, ()) if now - t < 1]
+        if (self.global_limit and len(self.sent) >= self.global_limit) or (self.chat_limit and len(chat_sent) >= self.chat_limit):
+            self.rejected += 1
+            return True
+        self.sent.append(now)
+        chat_sent.append(now)
+        return False
+
+    async def handle(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ('sendMessage', 'editMessageText') and self.over_limit(int(params['chat_id'])):
+            raise TooManyRequests(1)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params['chat_id'])
+            future = self.waiters.pop(chat_id, None)
+            if future is not None and not future.done():
+                future.set_result(time.perf_counter())
+            return self.message(chat_id, params.get('text', ''))
+        return True
+
+    def make_app(self):
+        import tornado.web
+        api = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                if self.request.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(self.request.body or b'{}')
+                else:
+                    params = {key: values[0].decode() for key, values in self.request.body_arguments.items()}
+                try:
+                    self.write({'ok': True, 'result': await api.handle(method, params)})
+                except TooManyRequests as e:
+                    self.set_status(429)
+                    self.write({
+                        'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {e.retry_after}',
+                        'parameters': {'retry_after': e.retry_after}
+                    })
+
+        return tornado.web.Application([(r'/bot([^/]+)/(\w+)', Handler)])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Апдейт Bot API с командой /start от пользователя chat_id
+def start_update(update_id, chat_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+        }
+    }
+
+
+def bench_webhook():
+    """Задержка «апдейт - ответ» в режиме webhook: апдейты отправляются по HTTP, ответы ловит имитация Bot API"""
+    from tornado.httpclient import AsyncHTTPClient
+
+    for name in ('tornado.access', 'httpx', 'telegram'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    api_latency = float(os.getenv('BENCH_API_LATENCY', '0.02'))
+
+    async def run(concurrency, count=300):
+        # Имитация Bot API не ограничивает частоту - меряется только обработка апдейтов
+        bot.OUTBOUND_GLOBAL_RATE = 1e6
+        bot.UPDATE_CONCURRENCY = concurrency
+        bot.BOT_TOKEN = '123456:fake'
+        api = FakeBotApi(latency=api_latency)
+        api_port, webhook_port = free_port(), free_port()
+        server = api.make_app().listen(api_port, address='127.0.0.1')
+        application = bot.build_application(base_url=f'http://127.0.0.1:{api_port}/bot')
+        secret = 'benchmark'
+        latencies = []
+        async with application:
+            await application.start()
+            await application.updater.start_webhook(
+                listen='127.0.0.1', port=webhook_port, url_path=bot.WEBHOOK_PATH,
+                webhook_url=f'http://127.0.0.1:{webhook_port}/{bot.WEBHOOK_PATH}',
+                secret_token=secret, allowed_updates=bot.ALLOWED_UPDATES
+            )
+            url = f'http://127.0.0.1:{webhook_port}/{bot.WEBHOOK_PATH}'
+            headers = {'X-Telegram-Bot-Api-Secret-Token': secret, 'Content-Type': 'application/json'}
+            # Telegram держит не больше max_connections (по умолчанию 40) одновременных запросов к webhook
+            poster = AsyncHTTPClient(force_instance=True, max_clients=40)
+
+            async def post(i):
+                chat_id = 1000 + i
+                reply = api.wait_reply(chat_id)
+                body = json.dumps(start_update(i + 1, chat_id))
+                started = time.perf_counter()
+                await poster.fetch(url, method='POST', body=body, headers=headers)
+                latencies.append(await reply - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(post(i) for i in range(count)))
+            elapsed = time.perf_counter() - started
+            poster.close()
+            await application.updater.stop()
+            await application.stop()
+        server.stop()
+        return count / elapsed, latencies
+
+    print(f'Webhook: 300 апдейтов /start, задержка Bot API {api_latency * 1000:.0f} мс')
+    for concurrency in (1, 16):
+        throughput, latencies = asyncio.run(run(concurrency))
+        print(f'UPDATE_CONCURRENCY={concurrency:<3} {throughput:>7.0f} апдейтов/сек, '
+              f'p50 {percentile(latencies, 50) * 1000:.0f} мс, p95 {percentile(latencies, 95) * 1000:.0f} мс')
+
+
+def bench_outbound():
+    """Исходящие сообщения против имитации Bot API с лимитами Telegram: с ограничителем и без"""
+    from telegram import Bot
+    from telegram.error import RetryAfter
+    from telegram.request import HTTPXRequest
+
+    for name in ('tornado.access', 'httpx', 'telegram', 'bot'):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+
+    chats, per_chat, edits = 50, 3, 20
+
+    async def run(limited):
+        api = FakeBotApi(latency=0.01, global_limit=32, chat_limit=4)
+        api_port = free_port()
+        server = api.make_app().listen(api_port, address='127.0.0.1')
+        base_url = f'http://127.0.0.1:{api_port}/bot'
+        bot.BOT_TOKEN = '123456:fake'
+        bot.OUTBOUND_GLOBAL_RATE = 30
+        if limited:
+            sender = bot.build_application(base_url=base_url).bot
+        else:
+            sender = Bot('123456:fake', base_url=base_url, request=HTTPXRequest(connection_pool_size=64))
+        delivered = failed = 0
+
+        async def send(chat_id, text):
+            nonlocal delivered, failed
+            try:
+                await sender.send_message(chat_id, text)
+                delivered += 1
+            except RetryAfter:
+                failed += 1
+
+        async with sender:
+            started = time.perf_counter()
+            # Много чатов по несколько сообщений и серия правок одного сообщения с прогрессом поиска
+            await asyncio.gather(
+                *(send(chat_id, f'сообщение {i}') for chat_id in range(1, chats + 1) for i in range(per_chat)),
+                *(sender.edit_message_text(f'найдено {i}', chat_id=chats + 1, message_id=1) for i in range(edits)),
+                return_exceptions=True
+            )
+            elapsed = time.perf_counter() - started
+        server.stop()
+        return delivered, failed, elapsed, api.calls.get('editMessageText', 0), api.rejected
+
+    print(f'{chats} чатов по {per_chat} сообщения и {edits} правок одного сообщения; '
+          f'имитация Bot API: 30/сек всего, 4/сек в чат')
+    for label, limited in (('без ограничителя', False), ('OutboundRateLimiter', True)):
+        delivered, failed, elapsed, edit_calls, rejected = asyncio.run(run(limited))
+        print(f'{label:<22} доставлено {delivered:>3}, потеряно {failed:>3}, ответов 429: {rejected:>3}, '
+              f'правок отправлено {edit_calls:>2} из {edits}, {delivered / elapsed:>5.1f} сообщ./сек')
+
+
+def bench_deep():
+    """Глубокий поиск: уточняющие запросы для терминов, по которым глобальный поиск упирается в лимит ответа"""
+    # Глобальный поиск Telegram отдает на запрос лишь несколько десятков каналов
+    client = FakeTelegramClient(make_corpus(20000), latency=0.05, page_limit=20)
+    queries = [['путешествия'], ['рецепты'], ['крипто', 'финансы'], ['дизайн', 'мода'], ['наука']]
+    saved = bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH, bot.DEEP_SEARCH_MAX_CALLS
+
+    async def run(query):
+        use_fake_accounts({'+0': client})
+        reset_storage()
+        calls_before = client.calls
+        started = time.perf_counter()
+        results = await bot.search_channels(query, bot.ADMIN_PHONE)
+        elapsed = time.perf_counter() - started
+        relevant = sum(score > 0 for score in bot.RelevanceScorer(query).term_scores(results))
+        return len(results), relevant, client.calls - calls_before, elapsed
+
+    print('Поиск при ответе глобального поиска до 20 каналов, кэш и локальный индекс выключены')
+    print(f'{"режим":<22} {"каналов":>8} {"релевантных":>12} {"запросов":>9} {"запросов на релевантный":>24} {"мс на поиск":>12}')
+    try:
+        bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH = 0, 10 ** 9
+        for label, max_calls in (('только термины плана', 0), ('глубокий поиск', saved[2] or 6)):
+            bot.DEEP_SEARCH_MAX_CALLS = max_calls
+            found = relevant = calls = elapsed = 0
+            for query in queries:
+                query_found, query_relevant, query_calls, query_elapsed = asyncio.run(run(query))
+                found += query_found
+                relevant += query_relevant
+                calls += query_calls
+                elapsed += query_elapsed
+            if not max_calls:
+                # Прежнее расширение с вариантами регистра находило те же каналы, что и термины плана
+                legacy_calls = sum(bot._legacy_variant_count(query) for query in queries)
+                print(f'{"варианты регистра":<22} {found:>8} {relevant:>12} {legacy_calls:>9} '
+                      f'{legacy_calls / max(1, relevant):>24.3f} {"-":>12}')
+            print(f'{label:<22} {found:>8} {relevant:>12} {calls:>9} {calls / max(1, relevant):>24.3f} {elapsed * 1000 / len(queries):>12.0f}')
+    finally:
+        bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH, bot.DEEP_SEARCH_MAX_CALLS = saved
+
+
+def bench_crawler():
+    """Обход категорий из словаря синонимов: сколько запросов к API остается дневным поискам по популярным темам"""
+    client = FakeTelegramClient(make_corpus(20000), latency=0.05)
+    queries = [[key] for key in bot.SYNONYMS]
+
+    async def searches():
+        calls_before = client.calls
+        started = time.perf_counter()
+        for query in queries:
+            await bot.search_channels(query, bot.ADMIN_PHONE)
+        return client.calls - calls_before, (time.perf_counter() - started) / len(queries)
+
+    async def run():
+        use_fake_accounts({'+0': client})
+        reset_storage()
+        cold_calls, cold_latency = await searches()
+
+        reset_storage()
+        crawler = bot.CategoryCrawler(
+            bot.get_db(), bot.get_channel_index(), '0-24', bot.CRAWL_MAX_CALLS, 0,
+            bot.CRAWL_REFINEMENTS, bot.CRAWL_INTERVAL, bot.CHANNEL_HISTORY_DAYS
+        )
+        started = time.perf_counter()
+        crawl_calls = await crawler.sweep(bot.get_client_pool())
+        crawl_elapsed = time.perf_counter() - started
+        history = bot.get_db().execute('SELECT COUNT(*) FROM channel_history').fetchone()[0]
+        warm_calls, warm_latency = await searches()
+        return cold_calls, cold_latency, crawl_calls, crawl_elapsed, history, warm_calls, warm_latency
+
+    cold_calls, cold_latency, crawl_calls, crawl_elapsed, history, warm_calls, warm_latency = asyncio.run(run())
+    print(f'Поиск по {len(queries)} ключам словаря синонимов')
+    print(f'{"без обхода":<16} запросов к API {cold_calls:>4}, в среднем {cold_latency * 1000:>6.1f} мс на поиск')
+    print(f'{"после обхода":<16} запросов к API {warm_calls:>4}, в среднем {warm_latency * 1000:>6.1f} мс на поиск')
+    print(f'Обход: {crawl_calls} запросов за {crawl_elapsed:.1f} сек (без пауз), записей истории подписчиков: {history}')
+
+
+# Синтетические слова из слогов: кириллица и латиница вперемешку
+def make_words(count, seed=3):
+    rng = random.Random(seed)
+    syllables = [c + v for c in 'бвгдзклмнпрстфхцчш' for v in 'аеиоуя'] + [c + v for c in 'bcdfgklmnprstvz' for v in 'aeiou']
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choices(syllables[:108] if rng.random() < 0.6 else syllables[108:], k=rng.randint(2, 5))))
+    return list(words)
+
+
+def bench_fuzzy():
+    """Нечеткий поиск по словарю известных каналов: время на термин и запросы к API, которые он заменяет"""
+    print(f'{"слов в словаре":>14} {"мкс на термин":>14}')
+    for size in (10000, 100000, 500000):
+        words = make_words(size)
+        vocabulary = bot.WordVocabulary(bot.FUZZY_MIN_LENGTH, bot.FUZZY_MAX_VARIANTS)
+        vocabulary.add(words)
+        rng = random.Random(size)
+        # Термины с одной опечаткой в случайной позиции
+        terms = []
+        for word in rng.sample(words, 200):
+            position = rng.randrange(len(word))
+            terms.append(word[:position] + rng.choice('аоеxyz') + word[position + 1:])
+        started = time.perf_counter()
+        vocabulary.variants(terms)
+        print(f'{size:>14} {(time.perf_counter() - started) / len(terms) * 1e6:>14.0f}')
+
+    vocabulary = bot.WordVocabulary(bot.FUZZY_MIN_LENGTH, bot.FUZZY_MAX_VARIANTS)
+    vocabulary.add(['Новости дня', 'novosti_msk', 'Крипто сигналы', 'Игра престолов', 'sports daily'])
+    for term in ('новасти', 'kripto', 'игры', 'спорт'):
+        print(f'{term:<10} -> {", ".join(vocabulary.variants([term]).get(term, []))}')
+
+    # Формы слов и транслитерации среди синонимов не запрашиваются у API отдельно,
+    # если словарь локального индекса знает варианты термина; с пустым индексом запрашивается все
+    def planned_calls():
+        return sum(len(bot.plan_search_terms([key]).terms) for key in bot.SYNONYMS)
+
+    reset_storage()
+    empty = planned_calls()
+    words = list(bot.SYNONYMS) + [word for synonyms in bot.SYNONYMS.values() for word in synonyms]
+    bot.get_channel_index().add([dict(make_channel(f'synonym{i}'), title=word) for i, word in enumerate(words)])
+    planned = planned_calls()
+    is_spelling_variant = bot._is_spelling_variant
+    bot._is_spelling_variant = lambda term, terms, vocabulary: False
+    try:
+        before = planned_calls()
+    finally:
+        bot._is_spelling_variant = is_spelling_variant
+    print(f'Запросов к API по {len(bot.SYNONYMS)} ключам словаря синонимов: {before} -> {planned} '
+          f'(с пустым локальным индексом {empty})')
+
+
+def bench_export():
+    """Выгрузка /export: пиковая память и самая долгая блокировка цикла событий на 50 000 каналов"""
+    import tracemalloc
+    corpus = make_corpus(50000)
+    reset_storage()
+    store = bot.get_session_store()
+    session = store.create(1, ['новости'])
+    store.set_results(session, corpus)
+    bot.get_channel_index().add(corpus)
+    fake_bot = FakeBot()
+
+    async def measure(export):
+        # Фоновая задача замечает, насколько надолго выгрузка занимает цикл событий
+        longest_stall = 0
+        running = True
+
+        async def ticker():
+            nonlocal longest_stall
+            while running:
+                started = time.perf_counter()
+                await asyncio.sleep(0)
+                longest_stall = max(longest_stall, time.perf_counter() - started)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        tracemalloc.start()
+        started = time.perf_counter()
+        await export()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        running = False
+        await task
+        return elapsed, peak, longest_stall
+
+    def handler(args):
+        async def export():
+            update, context = make_message_update(fake_bot, 1, '/export')
+            context.args = args
+            await bot.export_results(update, context)
+        return export
+
+    # Для сравнения - файл целиком собирается в одну строку
+    async def one_string():
+        lines = [json.dumps(record.as_dict(), ensure_ascii=False) for record in session.results]
+        return '\n'.join(lines).encode('utf-8')
+
+    # Для сравнения - выгрузка одним документом без предела размера
+    def single_file(export):
+        async def run():
+            saved = bot.EXPORT_FILE_MAX_BYTES
+            bot.EXPORT_FILE_MAX_BYTES = 0
+            try:
+                await export()
+            finally:
+                bot.EXPORT_FILE_MAX_BYTES = saved
+        return run
+
+    print(f'Выгрузка {len(corpus)} каналов, документы до {bot.EXPORT_FILE_MAX_BYTES / 2 ** 20:.1f} МБ '
+          f'(пик памяти включает чтение документа при отправке, как в PTB)')
+    print(f'{"способ":<30} {"время":>8} {"пик памяти":>12} {"блокировка цикла":>18} {"файлы":>16}')
+    for label, export in (
+        ('одной строкой (для сравнения)', one_string),
+        ('/export jsonl одним файлом', single_file(handler(['jsonl']))),
+        ('/export csv', handler(['csv'])),
+        ('/export jsonl', handler(['jsonl'])),
+        ('/export csv из каталога', handler(['csv', 'новости, крипто'])),
+    ):
+        documents = len(fake_bot.documents)
+        elapsed, peak, stall = asyncio.run(measure(export))
+        sizes = [size for _, size in fake_bot.documents[documents:]]
+        files = f'{len(sizes)} × до {max(sizes) / 2 ** 20:.1f} МБ' if sizes else '-'
+        print(f'{label:<30} {elapsed * 1000:>6.0f} мс {peak / 2 ** 20:>9.1f} МБ {stall * 1000:>15.1f} мс {files:>16}')
+
+    # Текст каналов не должен попасть в табличный редактор формулой
+    hostile = [
+        dict(make_channel(f'formula{i}'), title=text, description=text)
+        for i, text in enumerate(('=HYPERLINK("http://example.com")', '+1+1', '-2+3', '@SUM(A1)', '\t=1', '\r=1'))
+    ]
+    file = io.BytesIO()
+    asyncio.run(bot.write_export([hostile], 'csv', file))
+    rows = list(csv.reader(io.StringIO(file.getvalue().decode('utf-8-sig'))))[1:]
+    unsafe = [cell for row in rows for cell in row if cell.startswith(bot.CSV_FORMULA_PREFIXES)]
+    print(f'Ячеек, начинающихся с формулы, в CSV: {len(unsafe)} из {len(hostile) * 2}')
+    if unsafe:
+        FAILURES.append(f'export: {len(unsafe)} ячеек CSV начинаются с формулы')
+
+
+# Сумма счетчика bot.METRICS по всем меткам
+def counter_total(name):
+    return sum(value for (counter, _), value in bot.METRICS.counters.items() if counter == name)
+
+
+# Проваленные проверки и превышенные бюджеты: после всех бенчмарков main завершается с кодом 1
+FAILURES = []
+
+
+# Сравнение показателя с бюджетом из переменной окружения
+def check_budget(variable, label, value):
+    limit = os.getenv(variable)
+    if limit and value > float(limit):
+        FAILURES.append(f'{label}: {value:.1f} при бюджете {variable}={limit}')
+        print(f'{"":<24} превышен бюджет {variable}={limit}: {value:.1f}')
+
+
+def latency_line(label, latencies, elapsed):
+    return (f'{label:<24} {len(latencies):>6} {len(latencies) / elapsed:>10.1f}/сек '
+            f'p50 {percentile(latencies, 50) * 1000:>7.1f} мс  p95 {percentile(latencies, 95) * 1000:>7.1f} мс  '
+            f'p99 {percentile(latencies, 99) * 1000:>7.1f} мс')
+
+
+def bench_load():
+    """Нагрузочный прогон search_channels, show_channels_buttons и handle_pagination на имитациях Telegram и Bot API"""
+    sizes = [int(size) for size in os.getenv('BENCH_CORPUS', '1000,100000').split(',')]
+    telegram_latency = float(os.getenv('BENCH_TELEGRAM_LATENCY', '0.2'))
+    api_latency = float(os.getenv('BENCH_API_LATENCY', '0.02'))
+    flood_rate = float(os.getenv('BENCH_FLOOD_RATE', '0.01'))
+    flood_seconds = int(os.getenv('BENCH_FLOOD_SECONDS', '2'))
+    users = int(os.getenv('BENCH_USERS', '50'))
+    rounds = int(os.getenv('BENCH_ROUNDS', '3'))
+    rng = random.Random(21)
+    words = ['новости', 'крипто', 'спорт', 'музыка', 'игры', 'tech', 'news', 'бизнес', 'кино', 'юмор',
+             'авто', 'путешествия', 'рецепты', 'наука', 'дизайн', 'финансы', 'мода']
+    queries = [', '.join(rng.sample(words, rng.randint(1, 2))) for _ in range(200)]
+    clicks = ['next_page', 'next_page', 'detailed_view', 'back_to_list', 'prev_page']
+
+    print(f'Задержка Telegram {telegram_latency} сек, Bot API {api_latency} сек, FloodWait {flood_rate:.0%} '
+          f'по {flood_seconds} сек, {users} пользователей × {rounds} поисков')
+
+    async def run(corpus, accounts, warm):
+        use_fake_accounts(accounts)
+        reset_storage()
+        if warm:
+            # Прогретый бот: в локальном индексе уже весь корпус
+            index = bot.get_channel_index()
+            for start in range(0, len(corpus), 10000):
+                index.add(corpus[start:start + 10000])
+        fake_bot = FakeBot(latency=api_latency)
+        semaphore = asyncio.Semaphore(users)
+        search_latencies = []
+
+        # Поиск без обработчиков: сколько стоит сам конвейер и сколько запросов к API он делает
+        async def search(query):
+            async with semaphore:
+                started = time.perf_counter()
+                await bot.search_channels([term.strip() for term in query.split(',')], bot.ADMIN_PHONE)
+                search_latencies.append(time.perf_counter() - started)
+
+        calls_before = sum(client.calls for client in accounts.values())
+        floods_before = counter_total('telegram_flood_waits_total')
+        started = time.perf_counter()
+        await asyncio.gather(*(search(rng.choice(queries)) for _ in range(users * rounds)))
+        search_elapsed = time.perf_counter() - started
+        api_calls = sum(client.calls for client in accounts.values()) - calls_before
+        floods = counter_total('telegram_flood_waits_total') - floods_before
+
+        # Пользователи: поиск через обработчик с показом первой страницы, затем листание
+        handler_latencies = []
+        click_latencies = []
+
+        async def user(user_id):
+            context = SimpleNamespace(bot=fake_bot, user_data={})
+            for _ in range(rounds):
+                update, _ = make_message_update(fake_bot, user_id, rng.choice(queries))
+                started = time.perf_counter()
+                await bot.get_search_terms(update, context)
+                handler_latencies.append(time.perf_counter() - started)
+                for data in clicks:
+                    started = time.perf_counter()
+                    await bot.handle_pagination(make_callback_update(fake_bot, user_id, data), context)
+                    click_latencies.append(time.perf_counter() - started)
+
+        bot_calls_before = fake_bot.calls
+        started = time.perf_counter()
+        await asyncio.gather(*(user(user_id) for user_id in range(1, users + 1)))
+        users_elapsed = time.perf_counter() - started
+        bot_calls = fake_bot.calls - bot_calls_before
+        searches = len(search_latencies)
+        return (search_latencies, search_elapsed, api_calls / searches, floods,
+                handler_latencies, click_latencies, users_elapsed,
+                bot_calls / (len(handler_latencies) + len(click_latencies)))
+
+    saved = bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH, bot.MAX_RESULTS
+    try:
+        for size in sizes:
+            corpus = make_corpus(size)
+            accounts = {
+                f'+{i}': FakeTelegramClient(corpus, latency=telegram_latency, flood_rate=flood_rate,
+                                            flood_seconds=flood_seconds, seed=i)
+                for i in range(2)
+            }
+            # Миллион словарей корпуса - данные имитации, а не бота: сборщик мусора не должен их обходить
+            gc.collect()
+            gc.freeze()
+            for label, warm in (('холодный', False), ('прогретый', True)):
+                if warm:
+                    bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH, bot.MAX_RESULTS = saved
+                else:
+                    # Без кэша и локального индекса каждый термин уходит в глобальный поиск
+                    bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH = 0, 10 ** 9
+                (search_latencies, search_elapsed, api_per_query, floods, handler_latencies,
+                 click_latencies, users_elapsed, bot_per_op) = asyncio.run(run(corpus, accounts, warm))
+                print(f'\nКорпус {size} каналов, {label} бот')
+                print(latency_line('search_channels', search_latencies, search_elapsed))
+                print(f'{"":<24} запросов к Telegram на поиск: {api_per_query:.1f}, FloodWait: {floods}')
+                print(latency_line('поиск с показом страницы', handler_latencies, users_elapsed))
+                print(latency_line('листание', click_latencies, users_elapsed))
+                print(f'{"":<24} вызовов Bot API на действие: {bot_per_op:.1f}')
+                run_label = f'{size} каналов, {label} бот'
+                check_budget('BENCH_MAX_P95_MS', f'{run_label}, p95 поиска с показом страницы',
+                             percentile(handler_latencies, 95) * 1000)
+                check_budget('BENCH_MAX_CLICK_P95_MS', f'{run_label}, p95 листания', percentile(click_latencies, 95) * 1000)
+                check_budget('BENCH_MAX_CALLS_PER_SEARCH', f'{run_label}, запросов к Telegram на поиск', api_per_query)
+            del corpus, accounts
+            gc.unfreeze()
+    finally:
+        bot.SEARCH_CACHE_TTL, bot.LOCAL_INDEX_ENOUGH, bot.MAX_RESULTS = saved
+
+
+BENCHMARKS = {
+    'accumulator': bench_accumulator,
+    'synonyms': bench_synonyms,
+    'scoring': bench_scoring,
+    'deadline': bench_deadline,
+    'handlers': bench_handlers,
+    'updates': bench_updates,
+    'sessions': bench_sessions,
+    'enrichment': bench_enrichment,
+    'pagination': bench_pagination,
+    'webhook': bench_webhook,
+    'outbound': bench_outbound,
+    'deep': bench_deep,
+    'crawler': bench_crawler,
+    'fuzzy': bench_fuzzy,
+    'export': bench_export,
+    'load': bench_load,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f'Неизвестный бенчмарк: {name}. Доступны: {", ".join(BENCHMARKS)}')
+            sys.exit(1)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
+    if FAILURES:
+        print('Не пройдено:')
+        for failure in FAILURES:
+            print(f'  {failure}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,35 @@
 import os
+import re
+import sys
+import copy
+import json
+import math
+import time
+import bisect
+import random
+import cProfile
+import csv
+import io
+import tempfile
+import contextlib
+import itertools
+import sqlite3
+import asyncio
+import html
 import logging
+import weakref
+import unicodedata
+from array import array
+from collections import OrderedDict, Counter, deque
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
-from telethon.sync import TelegramClient
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler, BaseUpdateProcessor, BaseRateLimiter
+from telegram.error import RetryAfter, TimedOut
+from telethon import TelegramClient, events
 from telethon.tl.functions.contacts import SearchRequest
-
-# Добавляем словарь синонимов и переводов
-SYNONYMS = {
-    'видео': ['video', 'videos', 'видеоролик', 'видеозапись', 'ролик', 'фильм', 'movie'],
-    'video': ['видео', 'videos', 'видеоролик', 'видеозапись', 'ролик', 'фильм', 'movie'],
-    'новости': ['news', 'новость', 'события', 'сводка', 'вести', 'информация', 'updates'],
-    'news': ['новости', 'новость', 'события', 'сводка', 'вести', 'информация', 'updates'],
-    'спорт': ['sport', 'sports', 'физкультура', 'атлетика', 'соревнования', 'тренировки', 'физическая активность'],
-    'sport': ['спорт', 'sports', 'физкультура', 'атлетика', 'соревнования', 'тренировки', 'физическая активность'],
-    'музыка': ['music', 'трек', 'песня', 'композиция', 'мелодия', 'song', 'audio'],
-    'music': ['музыка', 'трек', 'песня', 'композиция', 'мелодия', 'song', 'audio'],
-    'игры': ['games', 'game', 'игра', 'геймплей', 'развлечение', 'gaming', 'киберспорт'],
-    'game': ['игры', 'games', 'игра', 'геймплей', 'развлечение', 'gaming', 'киберспорт'],
-    'технологии': ['tech', 'technology', 'техника', 'инновации', 'гаджеты', 'девайсы', 'электроника'],
-    'tech': ['технологии', 'technology', 'техника', 'инновации', 'гаджеты', 'девайсы', 'электроника'],
-    'бизнес': ['business', 'компания', 'предпринимательство', 'дело', 'работа', 'стартап', 'финансы'],
-    'business': ['бизнес', 'компания', 'предпринимательство', 'дело', 'работа', 'стартап', 'финансы'],
-    'красота': ['beauty', 'стиль', 'мода', 'косметика', 'макияж', 'уход', 'fashion'],
-    'beauty': ['красота', 'стиль', 'мода', 'косметика', 'макияж', 'уход', 'fashion'],
-    'еда': ['food', 'кулинария', 'рецепты', 'питание', 'кухня', 'cooking', 'блюда'],
-    'food': ['еда', 'кулинария', 'рецепты', 'питание', 'кухня', 'cooking', 'блюда'],
-}
-
-# Функция для получения синонимов и связанных слов
-def get_synonyms(word):
-    """Возвращает список синонимов и связанных слов для данного слова"""
-    word = word.lower()
-    if word in SYNONYMS:
-        return SYNONYMS[word]
-    # Проверяем частичные совпадения для составных слов
-    for key, values in SYNONYMS.items():
-        if key in word or word in key:
-            return values
-    return []
-
-# Обрабатываем возможные конфликты циклов событий между Telethon и python-telegram-bot
-import nest_asyncio
-nest_asyncio.apply()
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.errors import FloodWaitError
+from telethon.tl.types import UpdateChannel, InputChannel
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -70,22 +57,481 @@ BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 MAX_RESULTS = int(os.getenv('MAX_RESULTS', '100'))
 ADMIN_PHONE = os.getenv('PHONE_NUMBER', '')
 
+# Аккаунты для поисковых запросов (через запятую), у каждого свой файл session_<номер>.session
+SEARCH_PHONE_NUMBERS = [phone.strip() for phone in os.getenv('SEARCH_PHONE_NUMBERS', '').split(',') if phone.strip()]
+if ADMIN_PHONE and ADMIN_PHONE not in SEARCH_PHONE_NUMBERS:
+    SEARCH_PHONE_NUMBERS.insert(0, ADMIN_PHONE)
+# Как часто фоновая задача переподключает отключившиеся и неавторизованные аккаунты пула (сек)
+POOL_RECONNECT_INTERVAL = int(os.getenv('POOL_RECONNECT_INTERVAL', '60'))
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+
+# Сколько обновлений обрабатывается одновременно; обновления одного пользователя все равно идут по очереди
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+
+# Кнопки, которые только листают результаты: не ждут окончания поиска того же пользователя
+NAVIGATION_CALLBACKS = {'prev_page', 'next_page', 'detailed_view', 'back_to_list', 'ignore'}
+
+# Ограничения исходящих сообщений Bot API: всего в секунду, в личный чат в секунду (с допустимым всплеском),
+# в группу в секунду, и сколько раз повторять запрос после 429
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_GROUP_RATE = 20 / 60
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+
+# Методы, которые Telegram считает сообщениями и ограничивает; правки, которые можно сливать;
+# запросы, которые безопасно повторить после таймаута
+RATE_LIMITED_ENDPOINTS = {'sendMessage', 'sendDocument', 'editMessageText', 'editMessageReplyMarkup'}
+MERGEABLE_ENDPOINTS = {'editMessageText', 'editMessageReplyMarkup'}
+IDEMPOTENT_ENDPOINTS = {'editMessageText', 'editMessageReplyMarkup', 'deleteMessage', 'answerCallbackQuery', 'sendChatAction'}
+
+# Бот обрабатывает только сообщения и нажатия на кнопки - остальные обновления не запрашиваем
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Параметры параллельного поиска: число одновременных запросов и общий лимит времени поиска (в секундах)
+SEARCH_CONCURRENCY = int(os.getenv('SEARCH_CONCURRENCY', '5'))
+SEARCH_DEADLINE = float(os.getenv('SEARCH_DEADLINE', '5'))
+
+# Глубокий поиск: сколько уточняющих запросов можно добавить к одному поиску (0 - выключен), после
+# скольких найденных глобальным поиском каналов уточнения не нужны, сколько каналов должен вернуть термин,
+# чтобы его стоило уточнять, минимальная доля новых релевантных каналов в ответе на уточнение и число
+# подряд бесполезных уточнений, после которого термин больше не уточняется
+DEEP_SEARCH_MAX_CALLS = int(os.getenv('DEEP_SEARCH_MAX_CALLS', '6'))
+DEEP_SEARCH_TARGET = int(os.getenv('DEEP_SEARCH_TARGET', '100'))
+DEEP_SEARCH_MIN_HITS = int(os.getenv('DEEP_SEARCH_MIN_HITS', '10'))
+DEEP_SEARCH_MIN_YIELD = float(os.getenv('DEEP_SEARCH_MIN_YIELD', '0.2'))
+DEEP_SEARCH_PATIENCE = int(os.getenv('DEEP_SEARCH_PATIENCE', '2'))
+
+# Буквы в порядке убывания частоты начала слов: ими уточняются термины при глубоком поиске
+DEEP_SEARCH_LETTERS = {'cyrillic': 'пснкмвдотбагрлиэфзжчшхуеяцюй', 'latin': 'sctpbmdafrhegwilntouvkjyqzx'}
+
+# Доли общего лимита времени по этапам поиска (в порядке выполнения)
+SEARCH_STAGE_SHARES = {'global': 0.8, 'dialogs': 0.2}
+
+# Локальная база данных и кэш результатов поиска: время жизни записи, окно
+# stale-while-revalidate (в секундах) и максимальное число терминов в кэше
+DB_PATH = os.getenv('DB_PATH', 'bot_data.db')
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '21600'))
+SEARCH_CACHE_STALE_TTL = int(os.getenv('SEARCH_CACHE_STALE_TTL', '86400'))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '10000'))
+
+# Сколько каналов из локального индекса достаточно, чтобы не обращаться к глобальному поиску
+LOCAL_INDEX_ENOUGH = int(os.getenv('LOCAL_INDEX_ENOUGH', '30'))
+# Во сколько раз больше совпадений полнотекстового поиска берется перед сортировкой по числу подписчиков
+LOCAL_INDEX_OVERSAMPLE = int(os.getenv('LOCAL_INDEX_OVERSAMPLE', '10'))
+
+# Сессии поиска пользователей: сколько держать в памяти, через сколько секунд простоя выгружать
+# из памяти и сколько секунд хранить на диске
+SESSION_MAX_IN_MEMORY = int(os.getenv('SESSION_MAX_IN_MEMORY', '10000'))
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', '1800'))
+SESSION_RETENTION = int(os.getenv('SESSION_RETENTION', '604800'))
+
+# Фоновое дополнение каналов числом подписчиков и описанием: одновременных запросов (0 - выключено),
+# каналов в пачке, через сколько секунд данные канала запрашиваются заново, максимальная длина очереди
+ENRICH_CONCURRENCY = int(os.getenv('ENRICH_CONCURRENCY', '2'))
+ENRICH_BATCH_SIZE = int(os.getenv('ENRICH_BATCH_SIZE', '20'))
+ENRICH_TTL = int(os.getenv('ENRICH_TTL', '604800'))
+ENRICH_QUEUE_MAX = int(os.getenv('ENRICH_QUEUE_MAX', '1000'))
+
+# Обход популярных категорий из словаря синонимов в тихие часы: интервал часов по местному времени
+# (например, 3-7; пусто - обход выключен), бюджет запросов к API на один обход, пауза между запросами (сек),
+# уточняющих запросов на категорию, через сколько секунд термин запрашивается снова
+# и сколько дней хранить историю числа подписчиков
+CRAWL_HOURS = os.getenv('CRAWL_HOURS', '3-7')
+CRAWL_MAX_CALLS = int(os.getenv('CRAWL_MAX_CALLS', '300'))
+CRAWL_CALL_INTERVAL = float(os.getenv('CRAWL_CALL_INTERVAL', '5'))
+CRAWL_REFINEMENTS = int(os.getenv('CRAWL_REFINEMENTS', '4'))
+CRAWL_INTERVAL = int(os.getenv('CRAWL_INTERVAL', '72000'))
+CHANNEL_HISTORY_DAYS = int(os.getenv('CHANNEL_HISTORY_DAYS', '180'))
+
+# Нечеткий поиск по локальному индексу: минимальная длина термина, для которой ищутся опечатки
+# и варианты написания, и максимум вариантов на термин
+FUZZY_MIN_LENGTH = int(os.getenv('FUZZY_MIN_LENGTH', '4'))
+FUZZY_MAX_VARIANTS = int(os.getenv('FUZZY_MAX_VARIANTS', '5'))
+
+# Выгрузка /export: максимум каналов в выгрузке, каналов в одной порции записи, объем файла,
+# после которого он сбрасывается из памяти во временный файл на диске, и примерный предел размера
+# одного документа (байт). При отправке PTB читает документ в память целиком, поэтому большая
+# выгрузка делится на несколько документов
+EXPORT_MAX_ROWS = int(os.getenv('EXPORT_MAX_ROWS', '100000'))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
+EXPORT_SPOOL_SIZE = int(os.getenv('EXPORT_SPOOL_SIZE', str(1024 * 1024)))
+EXPORT_FILE_MAX_BYTES = int(os.getenv('EXPORT_FILE_MAX_BYTES', str(4 * 1024 * 1024)))
+EXPORT_FIELDS = ('title', 'username', 'link', 'description', 'participants_count')
+# Начальные символы, с которых табличные редакторы читают ячейку CSV как формулу
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+# Метрики в формате Prometheus: адрес и порт HTTP-эндпоинта /metrics (0 - не запускать)
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Выборочное профилирование: доля поисков, на время которых включается cProfile, и каталог для профилей
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# Число каналов на странице и минимальный интервал между обновлениями сообщения во время поиска (сек)
+CHANNELS_PER_PAGE = 6
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '2'))
+
+# Веса совпадений терминов в полях канала и вклад log10(число подписчиков) в оценку релевантности
+SCORE_WEIGHTS = {'title': 10.0, 'username': 6.0, 'description': 4.0}
+SCORE_SUBSCRIBERS_WEIGHT = 0.5
+
+# Снимок диалогов админского аккаунта: период обновления и минимальный интервал между обновлениями (сек)
+DIALOGS_REFRESH_INTERVAL = int(os.getenv('DIALOGS_REFRESH_INTERVAL', '600'))
+DIALOGS_REFRESH_MIN_GAP = int(os.getenv('DIALOGS_REFRESH_MIN_GAP', '30'))
+
+# Словарь синонимов и переводов загружается из внешнего файла
+SYNONYMS_PATH = os.getenv('SYNONYMS_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synonyms.json'))
+
+# Частичные совпадения ищутся только для слов не короче этой длины
+SYNONYM_PARTIAL_MIN_LENGTH = 3
+
+# Скомпилированный словарь синонимов
+class SynonymIndex:
+    """Точный и частичный поиск синонимов за время, не зависящее от размера словаря.
+
+    Для частичных совпадений заранее строится обратный индекс: подстрока -> ключи, которые её содержат.
+    Ключи, входящие в слово, находятся перебором подстрок самого слова.
+    """
+
+    def __init__(self, table):
+        self.table = {key.lower(): values for key, values in table.items()}
+        self.substrings = {}
+        for key in self.table:
+            parts = {key[i:j] for i in range(len(key)) for j in range(i + SYNONYM_PARTIAL_MIN_LENGTH, len(key) + 1)}
+            for part in parts:
+                self.substrings.setdefault(part, []).append(key)
+        self.max_key_length = max((len(key) for key in self.table), default=0)
+
+    def lookup(self, word):
+        """Возвращает синонимы слова; при частичном совпадении объединяет все подходящие записи"""
+        word = word.lower()
+        if word in self.table:
+            return list(self.table[word])
+        if len(word) < SYNONYM_PARTIAL_MIN_LENGTH:
+            return []
+
+        # Ключи, содержащие слово
+        keys = list(self.substrings.get(word, ()))
+        # Ключи, содержащиеся в слове
+        for i in range(len(word)):
+            for j in range(i + SYNONYM_PARTIAL_MIN_LENGTH, min(len(word), i + self.max_key_length) + 1):
+                if word[i:j] in self.table:
+                    keys.append(word[i:j])
+
+        synonyms = []
+        seen = {word}
+        for key in keys:
+            for value in [key] + self.table[key]:
+                if value not in seen:
+                    seen.add(value)
+                    synonyms.append(value)
+        return synonyms
+
+# Загрузка словаря синонимов из JSON-файла
+def load_synonyms(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось загрузить словарь синонимов из {path}: {e}")
+        return {}
+
+SYNONYMS = load_synonyms(SYNONYMS_PATH)
+SYNONYM_INDEX = SynonymIndex(SYNONYMS)
+
+# Функция для получения синонимов и связанных слов
+def get_synonyms(word):
+    """Возвращает список синонимов и связанных слов для данного слова"""
+    return SYNONYM_INDEX.lookup(word)
+
+# Счетчики и гистограммы в памяти процесса, отдаются в текстовом формате Prometheus
+class Metrics:
+    """Метрики без внешних зависимостей: обновление - одна операция со словарем, формат собирается при запросе"""
+
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # [границы, число значений в каждом интервале, сумма, общее число]
+            histogram = self.histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+        position = bisect.bisect_left(buckets, value)
+        if position < len(buckets):
+            histogram[1][position] += 1
+        histogram[2] += value
+        histogram[3] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name, read):
+        """Значение, которое читается в момент запроса метрик (длина очереди, число сессий)"""
+        self.gauges[name] = read
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def labels_text(labels, extra=()):
+            pairs = [f'{key}="{value}"' for key, value in (*labels, *extra)]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{labels_text(labels)} {value}')
+        for (name, labels), (buckets, counts, total, count) in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{labels_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{labels_text(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{labels_text(labels)} {total}')
+            lines.append(f'{name}_count{labels_text(labels)} {count}')
+        for name, read in sorted(self.gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                continue
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+# Ответ на HTTP-запрос к эндпоинту метрик
+async def serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Заголовки запроса не нужны, но их нужно дочитать
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', METRICS.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+# Выборочное профилирование: cProfile включается на время случайной доли поисков
+@contextlib.contextmanager
+def sampled_profile(name):
+    global PROFILING
+    if PROFILE_SAMPLE_RATE <= 0 or PROFILING or random.random() >= PROFILE_SAMPLE_RATE:
+        yield
+        return
+    # В профиль попадает все, что выполняется в цикле событий за время поиска, а не только сам поиск
+    profiler = cProfile.Profile()
+    PROFILING = True
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        PROFILING = False
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{random.randrange(10 ** 6)}.prof")
+            profiler.dump_stats(path)
+            logger.info(f"Профиль сохранен: {path}")
+        except OSError as e:
+            logger.error(f"Не удалось сохранить профиль: {e}")
+
 # Глобальные переменные
 AUTH_DATA = {}
-CLIENT = None
-
-# Функция для получения клиента Telethon (синглтон)
+CLIENTS = {}
+IN_FLIGHT_TERMS = {}
+BACKGROUND_TASKS = set()
+CLIENT_POOL = None
+DB = None
+SEARCH_CACHE = None
+CHANNEL_INDEX = None
+SESSION_STORE = None
+DIALOG_SNAPSHOT = None
+CHANNEL_ENRICHER = None
+CATEGORY_CRAWLER = None
+METRICS_SERVER = None
+PROFILING = False
+
+# Функция для получения клиента Telethon (один клиент на номер телефона)
 async def get_telethon_client(phone_number):
-    global CLIENT
-    if CLIENT is None or not CLIENT.is_connected():
-        CLIENT = TelegramClient('session_' + phone_number, API_ID, API_HASH)
+    client = CLIENTS.get(phone_number)
+    if client is None or not client.is_connected():
+        client = TelegramClient('session_' + phone_number, API_ID, API_HASH)
         # Увеличиваем таймауты для более стабильной работы
-        CLIENT.flood_sleep_threshold = 60  # Повышаем порог до 60 секунд
+        client.flood_sleep_threshold = 60  # Повышаем порог до 60 секунд
         # Добавляем параметры соединения для повышения стабильности
         connection_retries = 10
         retry_delay = 1
-        await CLIENT.connect()
-    return CLIENT
+        await client.connect()
+        CLIENTS[phone_number] = client
+    return client
+
+# Ни один аккаунт пула не может выполнить запрос: все в FloodWait или не авторизованы
+class AccountsUnavailableError(Exception):
+    def __init__(self, seconds):
+        super().__init__(f"Нет доступных аккаунтов, ближайший освободится через {seconds} сек")
+        self.seconds = seconds
+
+# Аккаунт в пуле клиентов
+class PooledAccount:
+    def __init__(self, phone_number):
+        self.phone_number = phone_number
+        self.client = None
+        self.authorized = False
+        self.in_flight = 0
+        self.calls = 0
+        self.flood_until = 0
+
+    def available(self, now):
+        return self.authorized and self.client.is_connected() and self.flood_until <= now
+
+# Пул авторизованных аккаунтов для поисковых запросов
+class ClientPool:
+    """Направляет запрос на наименее загруженный доступный аккаунт.
+
+    Вместо ожидания FloodWait аккаунт выводится из ротации до окончания ожидания,
+    а запрос повторяется на другом аккаунте.
+    """
+
+    def __init__(self, phone_numbers):
+        self.accounts = [PooledAccount(phone_number) for phone_number in phone_numbers]
+        self.task = None
+
+    def start(self, interval):
+        """Запускает фоновое переподключение: поиск никогда не ждет подключения аккаунта"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._keep_connected(interval))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _keep_connected(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            unhealthy = [
+                account for account in self.accounts
+                if not account.authorized or account.client is None or not account.client.is_connected()
+            ]
+            if unhealthy:
+                await self.connect(unhealthy)
+
+    async def connect(self, accounts=None):
+        """Подключает аккаунты пула (по умолчанию все); неавторизованные не участвуют в ротации"""
+        async def connect_account(account):
+            try:
+                account.client = await get_telethon_client(account.phone_number)
+                if not account.authorized:
+                    account.authorized = await account.client.is_user_authorized()
+                    if not account.authorized:
+                        logger.warning(f"Аккаунт {account.phone_number} не авторизован и исключен из пула")
+            except Exception as e:
+                account.authorized = False
+                logger.error(f"Не удалось подключить аккаунт {account.phone_number}: {e}")
+
+        await asyncio.gather(*(connect_account(account) for account in accounts or self.accounts))
+
+    def pick(self, exclude=()):
+        now = time.time()
+        candidates = [a for a in self.accounts if a not in exclude and a.available(now)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda a: (a.in_flight, a.calls))
+
+    def get(self, phone_number):
+        return next((a for a in self.accounts if a.phone_number == phone_number), None)
+
+    async def __call__(self, request):
+        return (await self.request(request))[1]
+
+    async def request(self, request):
+        """Выполняет запрос и возвращает его вместе с аккаунтом, который ответил"""
+        tried = []
+        while True:
+            account = self.pick(tried)
+            if account is None:
+                waits = [a.flood_until - time.time() for a in self.accounts if a.authorized]
+                raise AccountsUnavailableError(max(0, int(min(waits, default=0))))
+
+            account.in_flight += 1
+            account.calls += 1
+            METRICS.inc('telegram_api_calls_total', method=type(request).__name__)
+            try:
+                # Не засыпаем внутри Telethon: FloodWait обрабатывается переключением аккаунта.
+                # Telethon подставляет в запрос access_hash конкретного аккаунта, поэтому каждому аккаунту - своя копия
+                return account, await account.client(copy.copy(request), flood_sleep_threshold=0)
+            except FloodWaitError as e:
+                account.flood_until = time.time() + e.seconds
+                METRICS.inc('telegram_flood_waits_total', method=type(request).__name__)
+                METRICS.inc('telegram_flood_wait_seconds_total', e.seconds)
+                logger.warning(f"Аккаунт {account.phone_number} в FloodWait на {e.seconds} сек, исключен из ротации")
+                tried.append(account)
+            finally:
+                account.in_flight -= 1
+
+    async def call_on(self, account, request):
+        """Выполняет запрос через указанный аккаунт, например с access_hash, выданным именно ему.
+
+        FloodWait не выводит аккаунт из ротации поиска, а передается вызывающему.
+        """
+        account.in_flight += 1
+        account.calls += 1
+        METRICS.inc('telegram_api_calls_total', method=type(request).__name__)
+        try:
+            return await account.client(request, flood_sleep_threshold=0)
+        except FloodWaitError as e:
+            METRICS.inc('telegram_flood_waits_total', method=type(request).__name__)
+            METRICS.inc('telegram_flood_wait_seconds_total', e.seconds)
+            raise
+        finally:
+            account.in_flight -= 1
+
+# Функция для получения пула клиентов (синглтон); аккаунты подключает on_startup и фоновая задача пула
+def get_client_pool():
+    global CLIENT_POOL
+    if CLIENT_POOL is None:
+        CLIENT_POOL = ClientPool(SEARCH_PHONE_NUMBERS)
+    return CLIENT_POOL
 
 # Функция для аутентификации в Telethon
 async def authenticate_telethon(phone_number):
@@ -115,176 +561,1604 @@ async def complete_authentication(phone_number, code):
         logger.error(f"Ошибка при аутентификации: {e}")
         return False
 
-# Функция для поиска каналов через Telethon API
-async def search_channels(search_terms, phone_number):
-    results = []
-    logger.info(f"Начинаю поиск каналов по ключевым словам: {search_terms}")
+# Нормализация поискового термина: Unicode NFKC, удаление невидимых символов, приведение регистра
+def normalize_term(term):
+    """Возвращает каноническую форму термина для запроса к API и ключей кэшей"""
+    term = unicodedata.normalize('NFKC', term)
+    term = ''.join(ch for ch in term if unicodedata.category(ch) != 'Cf')
+    return ' '.join(term.casefold().split())
+
+# Транслитерация кириллица <-> латиница в том виде, в каком ее используют в юзернеймах каналов
+TRANSLIT_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+    'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '',
+    'э': 'e', 'ю': 'yu', 'я': 'ya'
+}
+TRANSLIT_TO_CYRILLIC = [
+    ('shch', 'щ'), ('sch', 'щ'), ('zh', 'ж'), ('kh', 'х'), ('ts', 'ц'), ('ch', 'ч'), ('sh', 'ш'), ('yu', 'ю'),
+    ('ya', 'я'), ('yo', 'ё'), ('a', 'а'), ('b', 'б'), ('c', 'к'), ('d', 'д'), ('e', 'е'), ('f', 'ф'), ('g', 'г'),
+    ('h', 'х'), ('i', 'и'), ('j', 'й'), ('k', 'к'), ('l', 'л'), ('m', 'м'), ('n', 'н'), ('o', 'о'), ('p', 'п'),
+    ('q', 'к'), ('r', 'р'), ('s', 'с'), ('t', 'т'), ('u', 'у'), ('v', 'в'), ('w', 'в'), ('x', 'кс'), ('y', 'ы'),
+    ('z', 'з')
+]
+TRANSLIT_PATTERN = re.compile('|'.join(latin for latin, _ in TRANSLIT_TO_CYRILLIC))
+
+# Функция для транслитерации термина в другую письменность
+def transliterate(term):
+    """Кириллицу переводит в латиницу и наоборот; для смешанных и прочих терминов возвращает пустую строку"""
+    cyrillic = any(char in TRANSLIT_TO_LATIN for char in term)
+    latin = any('a' <= char <= 'z' for char in term)
+    if cyrillic and not latin:
+        return ''.join(TRANSLIT_TO_LATIN.get(char, char) for char in term)
+    if latin and not cyrillic:
+        table = dict(TRANSLIT_TO_CYRILLIC)
+        return TRANSLIT_PATTERN.sub(lambda match: table[match.group()], term)
+    return ''
+
+# Функция для расстояния Левенштейна с ограничением
+def edit_distance(a, b, limit):
+    """Расстояние Левенштейна между строками или limit + 1, если оно больше limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        # Все значения строки больше limit - дальше расстояние только растет
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+# Термины, которые ранее вернули тот же набор каналов, что и другой термин: термин -> (канонический, срок действия)
+TERM_ALIASES = {}
+TERM_ALIAS_TTL = int(os.getenv('TERM_ALIAS_TTL', '86400'))
+
+class SearchPlan:
+    """План поиска: список терминов для SearchRequest и число запросов, которые сэкономил планировщик"""
+
+    def __init__(self, terms, legacy_count):
+        self.terms = terms
+        self.legacy_count = legacy_count
+
+    @property
+    def saved(self):
+        return max(0, self.legacy_count - len(self.terms))
+
+# Количество запросов, которое дало бы старое расширение с вариантами регистра
+def _legacy_variant_count(search_terms):
+    variants = set()
+    for term in search_terms:
+        for word in [term] + get_synonyms(term):
+            variants.update((word, word.lower(), word.upper(), word.capitalize()))
+        if term.lower() in ('video', 'видео'):
+            variants.update(('video', 'видео'))
+    return len(variants)
+
+# Синоним, который оказался формой слова или транслитерацией уже запланированного термина, не требует
+# отдельного запроса: его покрывает нечеткий поиск по локальному индексу, но только если словарь индекса
+# знает варианты этого термина. Ключи словаря синонимов (видео/video) - переводы, а не варианты
+# написания: Telegram находит по ним разные каналы
+def _is_spelling_variant(term, terms, vocabulary):
+    if len(term) < FUZZY_MIN_LENGTH:
+        return False
+    translit = '' if term in SYNONYM_INDEX.table else transliterate(term)
+    return any(
+        (planned == translit or (len(planned) >= FUZZY_MIN_LENGTH and edit_distance(term, planned, 1) <= 1))
+        and vocabulary.variants([planned])
+        for planned in terms
+    )
 
-    client = await get_telethon_client(phone_number)
+# Функция для планирования поисковых запросов
+def plan_search_terms(search_terms):
+    """Нормализует термины и синонимы, убирает дубликаты, термины-псевдонимы и варианты написания"""
+    now = time.time()
+    seen = set()
+    terms = []
+    vocabulary = get_channel_index().vocabulary
+    for term in search_terms:
+        for position, word in enumerate([term] + get_synonyms(term)):
+            normalized = normalize_term(word)
+            alias = TERM_ALIASES.get(normalized)
+            if alias:
+                if alias[1] > now:
+                    normalized = alias[0]
+                else:
+                    TERM_ALIASES.pop(normalized, None)
+            if normalized and normalized not in seen:
+                seen.add(normalized)
+                # Термины пользователя запрашиваются всегда, отбрасываются только синонимы
+                if position == 0 or not _is_spelling_variant(normalized, terms, vocabulary):
+                    terms.append(normalized)
+
+    plan = SearchPlan(terms, _legacy_variant_count(search_terms))
+    METRICS.inc('search_planner_calls_saved_total', plan.saved)
+    return plan
+
+# Запоминаем термины, вернувшие одинаковые наборы каналов, чтобы не запрашивать их повторно
+def remember_duplicate_terms(plan, term_signatures):
+    canonical = {}
+    expires_at = time.time() + TERM_ALIAS_TTL
+    for term in plan.terms:
+        signature = term_signatures.get(term)
+        if not signature:
+            continue
+        if signature in canonical:
+            TERM_ALIASES[term] = (canonical[signature], expires_at)
+            logger.debug(f"Термин '{term}' дублирует '{canonical[signature]}', будет пропускаться")
+        else:
+            canonical[signature] = term
+
+# Преобразование сущности Telethon в словарь канала (None, если это не публичный канал)
+def channel_from_entity(entity):
+    if not (getattr(entity, 'broadcast', False) and getattr(entity, 'username', None)):
+        return None
+    return {
+        'title': entity.title,
+        'username': entity.username,
+        'link': f'https://t.me/{entity.username}',
+        'description': getattr(entity, 'about', None) or 'Нет описания',
+        'participants_count': getattr(entity, 'participants_count', None) or 0
+    }
+
+# Кэш результатов SearchRequest в SQLite, переживает перезапуск бота
+class SearchCache:
+    """Хранит каналы, найденные по нормализованному термину, с TTL и вытеснением по LRU"""
+
+    def __init__(self, db, ttl, stale_ttl, max_entries):
+        self.db = db
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.refreshing = set()
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS search_cache ('
+            'term TEXT PRIMARY KEY, channels TEXT NOT NULL, fetched_at REAL NOT NULL, used_at REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS search_cache_used_at ON search_cache (used_at)')
+        self.db.commit()
+
+    def get(self, term):
+        """Возвращает (каналы, свежие ли данные) или None, если записи нет или она устарела окончательно"""
+        row = self.db.execute(
+            'SELECT channels, fetched_at FROM search_cache WHERE term = ?', (term,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        age = now - row[1]
+        if age > self.ttl + self.stale_ttl:
+            self.db.execute('DELETE FROM search_cache WHERE term = ?', (term,))
+            self.db.commit()
+            return None
+        self.db.execute('UPDATE search_cache SET used_at = ? WHERE term = ?', (now, term))
+        self.db.commit()
+        return json.loads(row[0]), age <= self.ttl
+
+    def put(self, term, channels):
+        now = time.time()
+        self.db.execute(
+            'INSERT OR REPLACE INTO search_cache (term, channels, fetched_at, used_at) VALUES (?, ?, ?, ?)',
+            (term, json.dumps(channels, ensure_ascii=False), now, now)
+        )
+        # Вытесняем давно не использованные записи сверх лимита
+        self.db.execute(
+            'DELETE FROM search_cache WHERE term IN ('
+            'SELECT term FROM search_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+        self.db.commit()
+
+# Словарь слов известных каналов для поиска с опечатками и в другой письменности
+class WordVocabulary:
+    """Слова из названий и юзернеймов каналов локального индекса с триграммным индексом.
+
+    Триграммы хранятся отдельно для каждой длины слова: кандидаты для термина длины L с допуском k
+    берутся только среди слов длины L±k, а затем проверяются расстоянием Левенштейна. Слово с k
+    ошибками теряет не больше 3k триграмм, поэтому остальные кандидаты отсекаются без проверки.
+    """
+
+    WORD = re.compile(r'[^\W\d_]+')
+
+    def __init__(self, min_length, max_variants):
+        self.min_length = min_length
+        self.max_variants = max_variants
+        self.ids = {}
+        self.words = []
+        self.postings = {}
+
+    @staticmethod
+    def _trigrams(word):
+        padded = f'${word}$'
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, texts):
+        for text in texts:
+            for word in self.WORD.findall(text.casefold()):
+                if len(word) < self.min_length or word in self.ids:
+                    continue
+                word_id = self.ids[word] = len(self.words)
+                self.words.append(word)
+                for trigram in self._trigrams(word):
+                    key = (trigram, len(word))
+                    posting = self.postings.get(key)
+                    if posting is None:
+                        posting = self.postings[key] = array('I')
+                    posting.append(word_id)
+
+    def lookup(self, term):
+        """Слова словаря на расстоянии не больше 1 (2 для длинных терминов) от термина: [(расстояние, слово)]"""
+        limit = 1 if len(term) <= 6 else 2
+        trigrams = self._trigrams(term)
+        counts = Counter(itertools.chain.from_iterable(
+            self.postings.get((trigram, length), ())
+            for trigram in trigrams
+            for length in range(len(term) - limit, len(term) + limit + 1)
+        ))
+        need = max(1, len(trigrams) - 3 * limit)
+        found = []
+        for word_id, shared in counts.items():
+            if shared >= need:
+                distance = edit_distance(term, self.words[word_id], limit)
+                if distance <= limit:
+                    found.append((distance, self.words[word_id]))
+        return sorted(found)
+
+    def variants(self, terms):
+        """Варианты написания терминов, которые встречаются в известных каналах: {термин: [слова]}.
+
+        Учитываются опечатки и транслитерация; слова, содержащие сам термин, не возвращаются -
+        их и так находит полнотекстовый поиск.
+        """
+        result = {}
+        for term in terms:
+            if len(term) < self.min_length or ' ' in term:
+                continue
+            candidates = self.lookup(term)
+            translit = transliterate(term)
+            if len(translit) >= self.min_length:
+                candidates += self.lookup(translit)
+            words = []
+            for _, word in sorted(candidates):
+                if term not in word and word not in words:
+                    words.append(word)
+                    if len(words) >= self.max_variants:
+                        break
+            if words:
+                result[term] = words
+        return result
+
+# Локальный индекс всех каналов, которые бот когда-либо видел
+class ChannelIndex:
+    """Полнотекстовый поиск по названию, юзернейму и описанию каналов (SQLite FTS5 с триграммами)"""
+
+    def __init__(self, db):
+        self.db = db
+        self.vocabulary = WordVocabulary(FUZZY_MIN_LENGTH, FUZZY_MAX_VARIANTS)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS channels ('
+            'username TEXT PRIMARY KEY COLLATE NOCASE, title TEXT NOT NULL, description TEXT NOT NULL, '
+            'participants_count INTEGER NOT NULL, updated_at REAL NOT NULL)'
+        )
+        # История числа подписчиков: одно значение на канал в день
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS channel_history ('
+            'username TEXT NOT NULL COLLATE NOCASE, day INTEGER NOT NULL, participants_count INTEGER NOT NULL, '
+            'PRIMARY KEY (username, day))'
+        )
+        try:
+            # Триграммный токенизатор ищет подстроки так же, как проверка релевантности в search_channels
+            self.db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5("
+                "title, username, description, content='channels', content_rowid='rowid', tokenize='trigram')"
+            )
+            self.db.executescript('''
+                CREATE TRIGGER IF NOT EXISTS channels_ai AFTER INSERT ON channels BEGIN
+                    INSERT INTO channels_fts (rowid, title, username, description)
+                    VALUES (new.rowid, new.title, new.username, new.description);
+                END;
+                CREATE TRIGGER IF NOT EXISTS channels_ad AFTER DELETE ON channels BEGIN
+                    INSERT INTO channels_fts (channels_fts, rowid, title, username, description)
+                    VALUES ('delete', old.rowid, old.title, old.username, old.description);
+                END;
+                DROP TRIGGER IF EXISTS channels_au;
+                CREATE TRIGGER channels_au AFTER UPDATE OF title, username, description ON channels BEGIN
+                    INSERT INTO channels_fts (channels_fts, rowid, title, username, description)
+                    VALUES ('delete', old.rowid, old.title, old.username, old.description);
+                    INSERT INTO channels_fts (rowid, title, username, description)
+                    VALUES (new.rowid, new.title, new.username, new.description);
+                END;
+            ''')
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 с триграммами недоступен, локальный индекс работает через LIKE: {e}")
+            self.fts = False
+        self.db.commit()
+
+    def add(self, channels):
+        """Добавляет или обновляет каналы; известные описание и число подписчиков не затираются пустыми"""
+        now = time.time()
+        self.db.executemany(
+            'INSERT INTO channels (username, title, description, participants_count, updated_at) '
+            'VALUES (?, ?, ?, ?, ?) ON CONFLICT (username) DO UPDATE SET '
+            'title = excluded.title, '
+            "description = CASE WHEN excluded.description != '' THEN excluded.description ELSE channels.description END, "
+            'participants_count = CASE WHEN excluded.participants_count > 0 '
+            'THEN excluded.participants_count ELSE channels.participants_count END, '
+            'updated_at = excluded.updated_at '
+            # Неизменившиеся строки не перезаписываются, чтобы не трогать полнотекстовый индекс
+            'WHERE excluded.title != channels.title '
+            "OR (excluded.description != '' AND excluded.description != channels.description) "
+            'OR (excluded.participants_count > 0 AND excluded.participants_count != channels.participants_count)',
+            [
+                (
+                    channel['username'],
+                    channel['title'],
+                    '' if channel['description'] == 'Нет описания' else (channel['description'] or ''),
+                    channel['participants_count'] or 0,
+                    now
+                )
+                for channel in channels
+            ]
+        )
+        self.db.commit()
+        self.vocabulary.add(f"{channel['title']} {channel['username']}" for channel in channels)
+
+    async def load_vocabulary(self, chunk_size=10000):
+        """Заполняет словарь для нечеткого поиска каналами из базы частями, не блокируя цикл событий"""
+        last_rowid = 0
+        while True:
+            rows = self.db.execute(
+                'SELECT rowid, title, username FROM channels WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (last_rowid, chunk_size)
+            ).fetchall()
+            if not rows:
+                break
+            self.vocabulary.add(f'{title} {username}' for _, title, username in rows)
+            last_rowid = rows[-1][0]
+            await asyncio.sleep(0)
+        logger.info(f"Словарь нечеткого поиска загружен, слов: {len(self.vocabulary.words)}")
+
+    def record_counts(self, channels):
+        """Сохраняет сегодняшнее число подписчиков каналов в историю"""
+        day = int(time.time() // 86400)
+        self.db.executemany(
+            'INSERT OR REPLACE INTO channel_history (username, day, participants_count) VALUES (?, ?, ?)',
+            [(channel['username'], day, channel['participants_count']) for channel in channels if channel['participants_count']]
+        )
+        self.db.commit()
+
+    def prune_history(self, days):
+        self.db.execute('DELETE FROM channel_history WHERE day < ?', (int(time.time() // 86400) - days,))
+        self.db.commit()
+
+    def search(self, terms, limit):
+        """Возвращает каналы, в названии, юзернейме или описании которых встречается любой из терминов"""
+        cursor = self._search_cursor(terms, limit, LOCAL_INDEX_OVERSAMPLE)
+        return [self._channel(*row) for row in cursor.fetchall()] if cursor else []
+
+    def iter_search(self, terms, limit, chunk_size):
+        """То же, что search, но отдает каналы частями по chunk_size, не загружая в память все сразу"""
+        # Выгрузка и так берет до limit совпадений, больше не нужно
+        cursor = self._search_cursor(terms, limit)
+        while cursor:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [self._channel(*row) for row in rows]
+
+    def _search_cursor(self, terms, limit, oversample=1):
+        # Триграммный индекс не работает с терминами короче трёх символов
+        terms = [term for term in terms if len(term) >= 3]
+        if not terms:
+            return None
+        if self.fts:
+            query = ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+            # Ранжирование всех совпадений по rank дорого на больших индексах (и блокирует цикл событий),
+            # поэтому берём в oversample раз больше первых совпадений, чем нужно, и из них - самые крупные
+            # каналы: иначе при плотных совпадениях ответом были бы просто самые старые записи
+            return self.db.execute(
+                'SELECT username, title, description, participants_count FROM channels WHERE rowid IN ('
+                'SELECT rowid FROM channels_fts WHERE channels_fts MATCH ? LIMIT ?) '
+                'ORDER BY participants_count DESC LIMIT ?',
+                (query, limit * oversample, limit)
+            )
+        condition = ' OR '.join(['(title LIKE ? OR username LIKE ? OR description LIKE ?)'] * len(terms))
+        params = [f'%{term}%' for term in terms for _ in range(3)]
+        return self.db.execute(
+            f'SELECT username, title, description, participants_count FROM channels '
+            f'WHERE {condition} ORDER BY participants_count DESC LIMIT ?',
+            params + [limit]
+        )
 
-    if not await client.is_user_authorized():
-        logger.info("Пользователь не авторизован, требуется аутентификация")
-        return "auth_required"
+    def get(self, usernames):
+        """Возвращает известные каналы по юзернеймам: {юзернейм в нижнем регистре: канал}"""
+        found = {}
+        usernames = list(usernames)
+        # Ограничение SQLite на число параметров запроса
+        for start in range(0, len(usernames), 500):
+            chunk = usernames[start:start + 500]
+            rows = self.db.execute(
+                f'SELECT username, title, description, participants_count FROM channels '
+                f'WHERE username IN ({", ".join("?" * len(chunk))})',
+                chunk
+            ).fetchall()
+            for row in rows:
+                found[row[0].lower()] = self._channel(*row)
+        return found
+
+    @staticmethod
+    def _channel(username, title, description, participants_count):
+        return {
+            'title': title,
+            'username': username,
+            'link': f'https://t.me/{username}',
+            'description': description or 'Нет описания',
+            'participants_count': participants_count
+        }
+
+# Канал в результатах поиска: одна запись на канал, общая для всех сессий
+class ChannelRecord:
+    __slots__ = ('title', 'username', 'description', 'participants_count', 'stored', '__weakref__')
+
+    def __init__(self, channel, stored=False):
+        self.title = channel['title']
+        self.username = channel['username']
+        self.description = channel['description']
+        self.participants_count = channel['participants_count'] or 0
+        # Запись уже есть в таблице channels - при сохранении сессии ее не нужно переписывать
+        self.stored = stored
+
+    def update(self, channel):
+        """Обновляет запись; известные описание и число подписчиков не затираются пустыми"""
+        changed = False
+        if channel['title'] != self.title:
+            self.title = channel['title']
+            changed = True
+        if channel['description'] not in ('', 'Нет описания', self.description):
+            self.description = channel['description']
+            changed = True
+        if (channel['participants_count'] or 0) > 0 and channel['participants_count'] != self.participants_count:
+            self.participants_count = channel['participants_count']
+            changed = True
+        return changed
+
+    @property
+    def incomplete(self):
+        return self.participants_count == 0 or self.description == 'Нет описания'
+
+    @property
+    def link(self):
+        return f'https://t.me/{self.username}'
+
+    def as_dict(self):
+        return {
+            'title': self.title,
+            'username': self.username,
+            'link': self.link,
+            'description': self.description,
+            'participants_count': self.participants_count
+        }
+
+# Результаты поиска одного пользователя: упорядоченные ссылки на общие записи и положение в списке
+class SearchSession:
+    __slots__ = (
+        'user_id', 'terms', 'results', 'page', 'partial', 'in_progress', 'chat_id', 'message_id', 'touched',
+        'renders', 'shown', 'version'
+    )
 
+    def __init__(self, user_id, terms=()):
+        self.user_id = user_id
+        self.terms = list(terms)
+        self.results = []
+        self.page = 0
+        self.partial = False
+        self.in_progress = False
+        self.chat_id = None
+        self.message_id = None
+        self.touched = time.monotonic()
+        # Готовые страницы (текст и клавиатура) и то, что сейчас показано в сообщении с результатами
+        self.renders = {}
+        self.shown = None
+        self.version = 0
+
+    def set_results(self, results):
+        self.results = results
+        self.renders.clear()
+
+# Хранилище сессий поиска: компактно в памяти, с сохранением в SQLite
+class SessionStore:
+    """Держит в памяти не больше max_sessions недавно активных сессий, остальные читает с диска.
+
+    Каналы хранятся один раз: сессии ссылаются на общие записи ChannelRecord, а на диске -
+    на строки таблицы channels по юзернейму.
+    """
+
+    def __init__(self, db, index, max_sessions, idle_ttl, retention):
+        self.db = db
+        self.index = index
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()
+        # Растет при обновлении записей каналов: страницы, собранные раньше, устарели
+        self.version = 0
+        # Запись канала живет, пока на нее ссылается хотя бы одна сессия
+        self.channels = weakref.WeakValueDictionary()
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'user_id INTEGER PRIMARY KEY, terms TEXT NOT NULL, usernames TEXT NOT NULL, page INTEGER NOT NULL, '
+            'partial INTEGER NOT NULL, chat_id INTEGER, message_id INTEGER, updated_at REAL NOT NULL)'
+        )
+        self.db.execute('DELETE FROM sessions WHERE updated_at < ?', (time.time() - retention,))
+        self.db.commit()
+
+    def intern(self, channel, stored=False):
+        """Возвращает общую запись канала, обновляя ее свежими данными"""
+        key = channel['username'].lower()
+        record = self.channels.get(key)
+        if record is None:
+            record = self.channels[key] = ChannelRecord(channel, stored)
+        elif record.update(channel):
+            record.stored = stored
+        return record
+
+    def refresh(self, channels):
+        """Обновляет записи каналов свежими данными; готовые страницы сессий пересобираются при следующем показе"""
+        changed = False
+        for channel in channels:
+            record = self.channels.get(channel['username'].lower())
+            if record is not None and record.update(channel):
+                record.stored = True
+                changed = True
+        if changed:
+            self.version += 1
+
+    def create(self, user_id, terms):
+        session = SearchSession(user_id, terms)
+        self._remember(session)
+        return session
+
+    def get(self, user_id):
+        """Сессия пользователя из памяти или с диска; None, если сессии нет"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = self._load(user_id)
+            if session is None:
+                return None
+        self._remember(session)
+        return session
+
+    def set_results(self, session, channels):
+        session.set_results([self.intern(channel) for channel in channels])
+
+    def save(self, session):
+        """Сохраняет сессию целиком; каналы попадают в общую таблицу channels"""
+        new = [record for record in session.results if not record.stored]
+        if new:
+            self.index.add([record.as_dict() for record in new])
+            for record in new:
+                record.stored = True
+        self.db.execute(
+            'INSERT OR REPLACE INTO sessions (user_id, terms, usernames, page, partial, chat_id, message_id, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                session.user_id, json.dumps(session.terms, ensure_ascii=False),
+                json.dumps([record.username for record in session.results]),
+                session.page, int(session.partial), session.chat_id, session.message_id, time.time()
+            )
+        )
+        self.db.commit()
+        self._remember(session)
+
+    def save_page(self, session):
+        """Сохраняет только номер страницы - без перезаписи списка каналов"""
+        self.db.execute(
+            'UPDATE sessions SET page = ?, updated_at = ? WHERE user_id = ?',
+            (session.page, time.time(), session.user_id)
+        )
+        self.db.commit()
+
+    def delete(self, user_id):
+        self.sessions.pop(user_id, None)
+        self.db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+        self.db.commit()
+
+    def _load(self, user_id):
+        row = self.db.execute(
+            'SELECT terms, usernames, page, partial, chat_id, message_id FROM sessions WHERE user_id = ?',
+            (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        terms, usernames, page, partial, chat_id, message_id = row
+        usernames = json.loads(usernames)
+        known = self.index.get(usernames)
+        session = SearchSession(user_id, json.loads(terms))
+        session.set_results([self.intern(known[name.lower()], True) for name in usernames if name.lower() in known])
+        session.page = page
+        session.partial = bool(partial)
+        session.chat_id = chat_id
+        session.message_id = message_id
+        return session
+
+    def _remember(self, session):
+        now = time.monotonic()
+        session.touched = now
+        if session.version != self.version:
+            session.renders.clear()
+            session.version = self.version
+        self.sessions[session.user_id] = session
+        self.sessions.move_to_end(session.user_id)
+        # Самые давние сессии в начале: выгружаем простаивающие и лишние сверх лимита, кроме только что использованной
+        for _ in range(len(self.sessions) - 1):
+            user_id, oldest = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and now - oldest.touched < self.idle_ttl:
+                break
+            if oldest.in_progress:
+                # Идущий поиск еще пишет в сессию - ее нельзя выгрузить
+                self.sessions.move_to_end(user_id)
+            else:
+                del self.sessions[user_id]
+
+# Функция для получения соединения с локальной базой данных (синглтон)
+def get_db():
+    global DB
+    if DB is None:
+        DB = sqlite3.connect(DB_PATH, check_same_thread=False)
+        DB.execute('PRAGMA journal_mode=WAL')
+    return DB
+
+# Функция для получения кэша результатов поиска (синглтон)
+def get_search_cache():
+    global SEARCH_CACHE
+    if SEARCH_CACHE is None and SEARCH_CACHE_TTL > 0:
+        SEARCH_CACHE = SearchCache(get_db(), SEARCH_CACHE_TTL, SEARCH_CACHE_STALE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+    return SEARCH_CACHE
+
+# Функция для получения локального индекса каналов (синглтон)
+def get_channel_index():
+    global CHANNEL_INDEX
+    if CHANNEL_INDEX is None:
+        CHANNEL_INDEX = ChannelIndex(get_db())
+    return CHANNEL_INDEX
+
+# Функция для получения хранилища сессий поиска (синглтон)
+def get_session_store():
+    global SESSION_STORE
+    if SESSION_STORE is None:
+        SESSION_STORE = SessionStore(
+            get_db(), get_channel_index(), SESSION_MAX_IN_MEMORY, SESSION_IDLE_TTL, SESSION_RETENTION
+        )
+    return SESSION_STORE
+
+# Запрос к глобальному поиску Telegram по одному термину
+async def fetch_term(client, term):
+    logger.debug(f"Выполняю поиск по запросу: {term}")
+    # Увеличиваем лимит до максимально возможного
+    account, search_result = await client.request(SearchRequest(
+        q=term,
+        limit=100  # Максимально возможное значение для API
+    ))
+    channels = [channel_from_entity(chat) for chat in search_result.chats]
+    channels = [channel for channel in channels if channel]
+    cache = get_search_cache()
+    if cache:
+        cache.put(term, channels)
+    get_channel_index().add(channels)
+    if ENRICH_CONCURRENCY > 0:
+        get_channel_enricher().remember(account.phone_number, search_result.chats)
+    return channels
+
+# Запрос по термину с объединением одновременных одинаковых запросов
+async def fetch_term_coalesced(client, term):
+    """Если запрос по этому термину уже выполняется, ждём его результат вместо нового обращения к API"""
+    task = IN_FLIGHT_TERMS.get(term)
+    if task is None:
+        task = asyncio.create_task(fetch_term(client, term))
+        IN_FLIGHT_TERMS[term] = task
+        task.add_done_callback(lambda _: IN_FLIGHT_TERMS.pop(term, None))
+    else:
+        METRICS.inc('search_coalesced_total')
+        logger.debug(f"Запрос по термину {term} уже выполняется, ожидаю его результат")
+    # shield: отмена одного ожидающего (например, по дедлайну) не отменяет запрос для остальных
+    channels = await asyncio.shield(task)
+    # Каждый поиск получает свои копии, так как результаты объединяются с изменением словарей
+    return [dict(channel) for channel in channels]
+
+# Запуск фоновой задачи: ссылка на неё хранится до завершения, чтобы задачу можно было отменить при остановке
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+# Фоновое обновление устаревшей записи кэша
+async def refresh_term(client, term):
+    cache = get_search_cache()
     try:
-        # Расширенный поиск с дополнительными вариантами запросов
-        expanded_terms = []
-        for term in search_terms:
-            # Добавляем оригинальный термин
-            expanded_terms.append(term)
-
-            # Добавляем термин на английском и русском
-            if term.lower() == 'video' or term.lower() == 'видео':
-                expanded_terms.append('video')
-                expanded_terms.append('видео')
-
-            # Добавляем варианты с разными регистрами
-            expanded_terms.append(term.lower())
-            expanded_terms.append(term.upper())
-            expanded_terms.append(term.capitalize())
-
-            # Добавляем синонимы
-            synonyms = get_synonyms(term)
-            for synonym in synonyms:
-                expanded_terms.append(synonym)
-                expanded_terms.append(synonym.lower())
-                expanded_terms.append(synonym.upper())
-                expanded_terms.append(synonym.capitalize())
-
-        # Удаляем дубликаты
-        expanded_terms = list(set(expanded_terms))
-        logger.info(f"Расширенные поисковые термины: {expanded_terms}")
-
-        # Поиск через глобальный поиск Telegram с увеличенным лимитом
-        for term in expanded_terms:
-            logger.info(f"Выполняю поиск по запросу: {term}")
-            try:
-                # Увеличиваем лимит до максимально возможного
-                search_result = await client(SearchRequest(
-                    q=term,
-                    limit=100  # Максимально возможное значение для API
-                ))
-
-                for chat in search_result.chats:
-                    if hasattr(chat, 'username') and chat.username and hasattr(chat, 'broadcast') and chat.broadcast:
-                        # Проверяем соответствие запросу в разных вариантах написания
-                        title_lower = chat.title.lower()
-                        username_lower = chat.username.lower()
-                        about_lower = getattr(chat, 'about', '').lower()
-
-                        # Проверяем совпадение с любым из исходных терминов
-                        match_found = False
-                        for original_term in search_terms:
-                            original_term_lower = original_term.lower()
-                            if (original_term_lower in title_lower or
-                                original_term_lower in username_lower or
-                                original_term_lower in about_lower):
-                                match_found = True
-                                break
-
-                        # Если совпадение не найдено, но термин очень короткий (менее 3 символов),
-                        # проверяем более точное совпадение
-                        if not match_found and min(len(t) for t in search_terms) < 3:
-                            for original_term in search_terms:
-                                if original_term.lower() == title_lower or original_term.lower() == username_lower:
-                                    match_found = True
-                                    break
-
-                        channel_info = {
-                            'title': chat.title,
-                            'username': chat.username,
-                            'link': f'https://t.me/{chat.username}',
-                            'description': getattr(chat, 'about', 'Нет описания'),
-                            'participants_count': getattr(chat, 'participants_count', 0)
-                        }
-
-                        # Проверяем, нет ли уже такого канала в результатах
-                        if not any(r['username'] == channel_info['username'] for r in results):
-                            # Если термин найден в названии, добавляем в начало списка
-                            if match_found:
-                                results.insert(0, channel_info)
-                            else:
-                                results.append(channel_info)
-
-                        if len(results) >= MAX_RESULTS:
+        await fetch_term_coalesced(client, term)
+    except Exception as e:
+        logger.error(f"Ошибка при фоновом обновлении термина {term}: {e}")
+    finally:
+        cache.refreshing.discard(term)
+
+# Поиск по одному термину: сначала кэш, затем API
+async def search_term(client, term):
+    """Возвращает каналы по термину; устаревшие записи кэша отдаются сразу и обновляются в фоне"""
+    cache = get_search_cache()
+    cached = cache.get(term) if cache else None
+    if cached is None:
+        METRICS.inc('search_cache_requests_total', result='miss')
+        return await fetch_term_coalesced(client, term)
+
+    channels, fresh = cached
+    METRICS.inc('search_cache_requests_total', result='fresh' if fresh else 'stale')
+    if not fresh and term not in cache.refreshing:
+        cache.refreshing.add(term)
+        run_in_background(refresh_term(client, term))
+    return channels
+
+# Оценка релевантности каналов по исходным терминам
+class RelevanceScorer:
+    """Считает оценку для целой пачки каналов: совпадения терминов в полях плюс логарифм числа подписчиков.
+
+    Поля всех каналов пачки обрабатываются столбцами: значения поля склеиваются в одну строку через
+    разделитель, и каждый термин ищется одним проходом str.split по всей строке. Python-код работает
+    только с найденными вхождениями, а не с каждым каналом и термином.
+    """
+
+    # Разделитель значений в склеенном столбце; если он встретится в тексте канала, то заменяется пробелом
+    SEPARATOR = '\0'
+
+    def __init__(self, search_terms):
+        terms = {normalize_term(term).replace(self.SEPARATOR, '') for term in search_terms}
+        self.terms = [term for term in terms if term]
+
+    def _add_field_hits(self, scores, values, weight):
+        """Прибавляет weight к оценке канала за каждый термин, найденный в значении его поля"""
+        text = self.SEPARATOR.join(values).casefold()
+        if text.count(self.SEPARATOR) != len(scores) - 1:
+            text = self.SEPARATOR.join(value.replace(self.SEPARATOR, ' ') for value in values).casefold()
+        for term in self.terms:
+            pieces = text.split(term)
+            # Номер канала для вхождения - число разделителей перед ним; повторы термина в поле не считаются
+            rows = itertools.accumulate(map(str.count, pieces[:-1], itertools.repeat(self.SEPARATOR)))
+            for row in set(rows):
+                scores[row] += weight
+
+    def matches(self, channels):
+        """Есть ли у канала совпадение хотя бы с одним термином, без подсчета оценки.
+
+        Для ответа да/нет столбцы не выгодны: у большинства каналов термин находится уже в названии,
+        поэтому поля проверяются по одному каналу и следующее поле не приводится к нижнему регистру,
+        если совпадение уже найдено.
+        """
+        terms = self.terms
+        matched = []
+        for channel in channels:
+            title = channel['title'].casefold()
+            for term in terms:
+                if term in title:
+                    matched.append(True)
+                    break
+            else:
+                username = channel['username'].casefold()
+                for term in terms:
+                    if term in username:
+                        matched.append(True)
+                        break
+                else:
+                    description = channel.get('description') or ''
+                    description = '' if description == 'Нет описания' else description.casefold()
+                    for term in terms:
+                        if term in description:
+                            matched.append(True)
                             break
+                    else:
+                        matched.append(False)
+        return matched
+
+    def term_scores(self, channels):
+        """Взвешенное число совпадений терминов в названии, юзернейме и описании"""
+        scores = [0.0] * len(channels)
+        if not self.terms or not channels:
+            return scores
+        self._add_field_hits(scores, [channel['title'] for channel in channels], SCORE_WEIGHTS['title'])
+        self._add_field_hits(scores, [channel['username'] for channel in channels], SCORE_WEIGHTS['username'])
+        self._add_field_hits(scores, [
+            '' if channel.get('description') == 'Нет описания' else (channel.get('description') or '')
+            for channel in channels
+        ], SCORE_WEIGHTS['description'])
+        return scores
+
+    def scores(self, channels):
+        """Итоговая оценка: совпадения терминов плюс логарифм числа подписчиков"""
+        return [
+            term_score + SCORE_SUBSCRIBERS_WEIGHT * math.log10(1 + (channel.get('participants_count') or 0))
+            for channel, term_score in zip(channels, self.term_scores(channels))
+        ]
+
+    def rank(self, channels):
+        """Сортирует каналы по убыванию оценки, при равенстве сохраняя исходный порядок"""
+        scores = self.scores(channels)
+        order = sorted(range(len(channels)), key=lambda i: -scores[i])
+        return [channels[i] for i in order]
+
+# Общий лимит времени поиска, распределяемый между этапами
+class SearchBudget:
+    """Выдаёт этапу поиска оставшееся время за вычетом долей, зарезервированных для следующих этапов"""
+
+    def __init__(self, total, shares=None):
+        self.total = total
+        self.shares = shares or SEARCH_STAGE_SHARES
+        self.started = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        return max(0.0, self.total - self.elapsed())
+
+    def stage_timeout(self, stage):
+        stages = list(self.shares)
+        reserved = sum(self.shares[later] for later in stages[stages.index(stage) + 1:])
+        return max(0.0, self.remaining() - self.total * reserved)
+
+# Окончательный список каналов с признаком частичного результата
+class SearchResults(list):
+    def __init__(self, channels=(), partial=False):
+        super().__init__(channels)
+        self.partial = partial
+
+# Накопитель результатов поиска с дедупликацией по юзернейму за O(1)
+class ResultAccumulator:
+    """Собирает каналы без дубликатов: релевантные идут первыми, повторные находки объединяются"""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        # Ключ - юзернейм в нижнем регистре; словари сохраняют порядок добавления
+        self.matched = {}
+        self.others = {}
+
+    def __len__(self):
+        return len(self.matched) + len(self.others)
+
+    def is_full(self):
+        return self.limit is not None and len(self) >= self.limit
+
+    def add(self, channel, matched=False):
+        """Добавляет канал; возвращает True, если это новый канал"""
+        key = channel['username'].lower()
+        existing = self.matched.get(key)
+        if existing is None:
+            existing = self.others.get(key)
+        if existing is not None:
+            self._merge(existing, channel)
+            # Канал, найденный позже как релевантный, поднимаем в начало
+            if matched and key in self.others:
+                self.matched[key] = self.others.pop(key)
+            return False
+
+        if self.is_full():
+            return False
+        if matched:
+            self.matched[key] = channel
+        else:
+            self.others[key] = channel
+        return True
+
+    @staticmethod
+    def _merge(existing, channel):
+        if (channel.get('participants_count') or 0) > (existing.get('participants_count') or 0):
+            existing['participants_count'] = channel['participants_count']
+        if existing.get('description', 'Нет описания') == 'Нет описания' and channel.get('description'):
+            existing['description'] = channel['description']
+
+    def results(self):
+        return list(self.matched.values()) + list(self.others.values())
+
+# Снимок каналов из диалогов админского аккаунта
+class DialogSnapshot:
+    """Хранит каналы из всех диалогов в памяти и обновляет их в фоне по таймеру и по событиям Telethon"""
+
+    def __init__(self, interval, min_gap):
+        self.interval = interval
+        self.min_gap = min_gap
+        self.entries = []
+        self.updated_at = 0
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.ready = asyncio.Event()
+
+    def start(self, client):
+        """Запускает фоновое обновление, если оно ещё не запущено"""
+        if self.task is not None and not self.task.done():
+            return
+        client.add_event_handler(self._on_channel_update, events.Raw(types=[UpdateChannel]))
+        self.task = asyncio.create_task(self._run(client))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _on_channel_update(self, update):
+        # Вступление в канал, выход из него или изменение канала - обновляем снимок
+        self.wakeup.set()
+
+    async def _run(self, client):
+        while True:
+            try:
+                await self.refresh(client)
             except Exception as e:
-                logger.error(f"Ошибка при поиске по термину {term}: {e}")
+                logger.error(f"Ошибка при обновлении снимка диалогов: {e}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            # Не обновляем снимок чаще, чем раз в min_gap секунд, даже при потоке событий
+            await asyncio.sleep(max(0, self.updated_at + self.min_gap - time.time()))
+
+    async def refresh(self, client):
+        entries = []
+        async for dialog in client.iter_dialogs():
+            channel_info = channel_from_entity(dialog.entity)
+            if channel_info:
+                entries.append(channel_info)
+        self.entries = entries
+        self.updated_at = time.time()
+        self.ready.set()
+        logger.info(f"Снимок диалогов обновлен, каналов: {len(entries)}")
+
+    def match(self, scorer):
+        """Возвращает каналы, в названии, юзернейме или описании которых встречается любой из терминов"""
+        entries = self.entries
+        return [
+            dict(channel_info)
+            for channel_info, matched in zip(entries, scorer.matches(entries))
+            if matched
+        ]
+
+# Функция для получения снимка диалогов (синглтон)
+def get_dialog_snapshot():
+    global DIALOG_SNAPSHOT
+    if DIALOG_SNAPSHOT is None:
+        DIALOG_SNAPSHOT = DialogSnapshot(DIALOGS_REFRESH_INTERVAL, DIALOGS_REFRESH_MIN_GAP)
+    return DIALOG_SNAPSHOT
+
+# Фоновое дополнение каналов числом подписчиков и описанием
+class ChannelEnricher:
+    """Запрашивает GetFullChannelRequest для каналов без числа подписчиков или описания.
+
+    Работает вне пути поиска: результаты показываются сразу, а данные появляются при следующих
+    показах страниц. Время последнего запроса по каждому каналу хранится в SQLite, сами данные -
+    в таблице channels, поэтому повторно канал запрашивается не раньше, чем через ttl.
+
+    Канал запрашивается по id и access_hash через тот аккаунт, который нашел его в поиске: запрос по
+    юзернейму стоил бы аккаунту еще и ResolveUsername. FloodWait дополнения приостанавливает только
+    дополнение на этом аккаунте и не выводит его из ротации поиска.
+    """
+
+    def __init__(self, db, index, store, concurrency, batch_size, ttl, queue_size):
+        self.db = db
+        self.index = index
+        self.store = store
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.queue_size = queue_size
+        self.queue = []
+        self.queued = set()
+        # Аккаунт -> время, до которого дополнение через него приостановлено из-за FloodWait
+        self.paused = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS channel_enrichment ('
+            'username TEXT PRIMARY KEY COLLATE NOCASE, enriched_at REAL NOT NULL)'
+        )
+        # access_hash действителен только для аккаунта, который его получил
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS channel_access ('
+            'username TEXT PRIMARY KEY COLLATE NOCASE, phone_number TEXT NOT NULL, '
+            'channel_id INTEGER NOT NULL, access_hash INTEGER NOT NULL)'
+        )
+        self.db.commit()
+
+    def start(self, pool):
+        if self.concurrency > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run(pool))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def remember(self, phone_number, chats):
+        """Сохраняет id и access_hash каналов из результатов поиска аккаунта phone_number"""
+        rows = [
+            (chat.username, phone_number, chat.id, chat.access_hash)
+            for chat in chats
+            if getattr(chat, 'broadcast', False) and getattr(chat, 'username', None)
+            and getattr(chat, 'access_hash', None) is not None
+        ]
+        if rows:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO channel_access (username, phone_number, channel_id, access_hash) '
+                'VALUES (?, ?, ?, ?)',
+                rows
+            )
+            self.db.commit()
+
+    def submit(self, records):
+        """Ставит в очередь каналы без данных; уже запрошенные недавно берутся из таблицы channels"""
+        missing = {record.username.lower(): record.username for record in records if record.incomplete}
+        missing = {key: name for key, name in missing.items() if key not in self.queued}
+        if not missing:
+            return
+        recent = set()
+        access = {}
+        names = list(missing.values())
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = self.db.execute(
+                f'SELECT username FROM channel_enrichment WHERE enriched_at > ? AND username IN ({placeholders})',
+                [time.time() - self.ttl] + chunk
+            ).fetchall()
+            recent.update(username.lower() for (username,) in rows)
+            rows = self.db.execute(
+                f'SELECT username, phone_number, channel_id, access_hash FROM channel_access '
+                f'WHERE username IN ({placeholders})',
+                chunk
+            ).fetchall()
+            access.update((row[0].lower(), row[1:]) for row in rows)
+        if recent:
+            self.store.refresh(self.index.get(missing[key] for key in recent).values())
+        # Порядок сохраняется: каналы с первых страниц запрашиваются раньше.
+        # Каналы без access_hash ждут, пока их снова найдет поиск
+        for key, username in missing.items():
+            if key not in recent and key in access and len(self.queue) < self.queue_size:
+                self.queue.append((username, *access[key]))
+                self.queued.add(key)
+        self.wakeup.set()
+
+    def _ready(self, pool, phone_number, now):
+        """Через сколько секунд аккаунт освободится для дополнения (0 - свободен, None - недоступен)"""
+        account = pool.get(phone_number)
+        if account is None or not account.authorized:
+            return None
+        return max(account.flood_until, self.paused.get(phone_number, 0)) - now
+
+    async def _run(self, pool):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            # Каналы аккаунтов в FloodWait остаются в очереди, остальные идут в пакет по порядку
+            now = time.time()
+            batch, waiting, dropped, waits = [], [], [], []
+            for item in self.queue:
+                wait = self._ready(pool, item[1], now)
+                if wait is None:
+                    dropped.append(item)
+                elif wait > 0 or len(batch) >= self.batch_size:
+                    waiting.append(item)
+                    if wait > 0:
+                        waits.append(wait)
+                else:
+                    batch.append(item)
+            self.queue = waiting
+            # Аккаунт, нашедший канал, отключен или не авторизован - канал вернется из следующего поиска
+            self.queued.difference_update(item[0].lower() for item in dropped)
+            if not batch:
+                if waits:
+                    await asyncio.sleep(max(min(waits), 1))
                 continue
 
-            if len(results) >= MAX_RESULTS:
-                break
+            results = await asyncio.gather(
+                *(self._fetch(pool, semaphore, *item) for item in batch), return_exceptions=True
+            )
+            done = [item[0] for item, result in zip(batch, results) if not isinstance(result, BaseException)]
+            try:
+                self._store(done, [result for result in results if isinstance(result, dict)])
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении данных каналов: {e}")
+            self.queued.difference_update(username.lower() for username in done)
+            # Каналы, отложенные из-за FloodWait, вернутся в начало очереди
+            self.queue[:0] = [item for item, result in zip(batch, results) if isinstance(result, BaseException)]
+
+    async def _fetch(self, pool, semaphore, username, phone_number, channel_id, access_hash):
+        async with semaphore:
+            try:
+                full = await pool.call_on(
+                    pool.get(phone_number), GetFullChannelRequest(InputChannel(channel_id, access_hash))
+                )
+            except FloodWaitError as e:
+                self.paused[phone_number] = time.time() + e.seconds
+                logger.warning(f"Дополнение каналов через аккаунт {phone_number} приостановлено на {e.seconds} сек")
+                raise
+            except Exception as e:
+                # Канал удален, стал приватным или сменил юзернейм - больше не запрашиваем до истечения ttl
+                logger.debug(f"Не удалось получить данные канала {username}: {e}")
+                return None
+        chat = next((chat for chat in full.chats if chat.id == full.full_chat.id), None)
+        if chat is None:
+            return None
+        return {
+            'title': chat.title,
+            'username': username,
+            'link': f'https://t.me/{username}',
+            'description': full.full_chat.about or 'Нет описания',
+            'participants_count': full.full_chat.participants_count or 0
+        }
+
+    def _store(self, batch, channels):
+        if channels:
+            self.index.add(channels)
+            self.index.record_counts(channels)
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR REPLACE INTO channel_enrichment (username, enriched_at) VALUES (?, ?)',
+            [(username, now) for username in batch]
+        )
+        self.db.commit()
+        self.store.refresh(channels)
+        METRICS.inc('channels_enriched_total', len(channels))
+        logger.debug(f"Дополнены данные {len(channels)} из {len(batch)} каналов")
+
+# Функция для получения фонового дополнения каналов (синглтон)
+def get_channel_enricher():
+    global CHANNEL_ENRICHER
+    if CHANNEL_ENRICHER is None:
+        CHANNEL_ENRICHER = ChannelEnricher(
+            get_db(), get_channel_index(), get_session_store(),
+            ENRICH_CONCURRENCY, ENRICH_BATCH_SIZE, ENRICH_TTL, ENRICH_QUEUE_MAX
+        )
+    return CHANNEL_ENRICHER
+
+# Обход популярных категорий в тихие часы
+class CategoryCrawler:
+    """Заранее запрашивает ключи словаря синонимов и их синонимы, чтобы каталог каналов был свежим.
+
+    Работает только в интервале CRAWL_HOURS и тратит не больше max_calls запросов за обход. Найденные
+    каналы попадают в кэш поиска и локальный индекс, поэтому днем поиск по популярным темам отвечает
+    из индекса без обращения к API. Насыщенные категории уточняются так же, как при глубоком поиске.
+    Время последнего запроса по каждому термину хранится в SQLite и переживает перезапуск.
+    """
+
+    def __init__(self, db, index, hours, max_calls, call_interval, refinements, interval, history_days):
+        self.db = db
+        self.index = index
+        self.hours = self._parse_hours(hours)
+        self.max_calls = max_calls
+        self.call_interval = call_interval
+        self.refinements = refinements
+        self.interval = interval
+        self.history_days = history_days
+        self.task = None
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS crawl_state (term TEXT PRIMARY KEY, crawled_at REAL NOT NULL)'
+        )
+        self.db.commit()
 
-        # Дополнительный поиск среди популярных каналов
+    @staticmethod
+    def _parse_hours(hours):
+        if not hours.strip():
+            return None
         try:
-            popular_chats = await client.get_dialogs(limit=200)
-            for dialog in popular_chats:
-                entity = dialog.entity
-                if hasattr(entity, 'broadcast') and entity.broadcast and hasattr(entity, 'username') and entity.username:
-                    # Проверяем релевантность
-                    relevant = False
-                    title_lower = entity.title.lower()
-                    username_lower = entity.username.lower()
-                    about_lower = getattr(entity, 'about', '').lower() if hasattr(entity, 'about') else ''
-
-                    for term in search_terms:
-                        term_lower = term.lower()
-                        if (term_lower in title_lower or
-                            term_lower in username_lower or
-                            (about_lower and term_lower in about_lower)):
-                            relevant = True
-                            break
+            start, end = (int(hour) % 24 for hour in hours.split('-'))
+        except ValueError:
+            logger.error(f"Неверный формат CRAWL_HOURS: {hours}, ожидается начало-конец, например 3-7")
+            return None
+        return start, end
+
+    def start(self, pool):
+        if self.hours and self.max_calls > 0 and SYNONYMS and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run(pool))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def in_quiet_hours(self, now=None):
+        hour = time.localtime(now).tm_hour
+        start, end = self.hours
+        # Совпадающие начало и конец (например, 0-24) - обход разрешен круглые сутки
+        if start == end:
+            return True
+        return start <= hour < end if start < end else hour >= start or hour < end
+
+    def seconds_until_quiet_hours(self, now=None):
+        now = time.time() if now is None else now
+        local = time.localtime(now)
+        seconds = ((self.hours[0] - local.tm_hour) % 24) * 3600 - local.tm_min * 60 - local.tm_sec
+        return seconds if seconds > 0 else seconds + 86400
+
+    async def _run(self, pool):
+        while True:
+            if self.in_quiet_hours():
+                try:
+                    calls = await self.sweep(pool)
+                    logger.info(f"Обход категорий завершен, запросов к API: {calls}")
+                except Exception as e:
+                    logger.error(f"Ошибка при обходе категорий: {e}")
+            await asyncio.sleep(self.seconds_until_quiet_hours())
+
+    def _category_terms(self, key):
+        terms = []
+        for word in [key] + get_synonyms(key):
+            term = normalize_term(word)
+            if term and term not in terms:
+                terms.append(term)
+        return terms
+
+    async def sweep(self, pool):
+        """Один обход всех категорий; возвращает число выполненных запросов"""
+        calls = 0
+        crawled_after = time.time() - self.interval
+        fresh = {term for (term,) in self.db.execute(
+            'SELECT term FROM crawl_state WHERE crawled_at > ?', (crawled_after,)
+        )}
+        # История чистится и тогда, когда обход прерывается по лимиту запросов или концу тихих часов
+        try:
+            for key in SYNONYMS:
+                plan = DeepSearchPlan(
+                    [term for term in self._category_terms(key) if term not in fresh], [key],
+                    max_calls=self.refinements, target=float('inf')
+                )
+                scorer = RelevanceScorer([key])
+                for term in plan:
+                    if calls >= self.max_calls or not self.in_quiet_hours():
+                        return calls
+                    if term in fresh:
+                        continue
+                    try:
+                        channels = await fetch_term(pool, term)
+                    except AccountsUnavailableError as e:
+                        # Все аккаунты в FloodWait - термин будет запрошен в следующий обход
+                        await asyncio.sleep(e.seconds + 1)
+                        continue
+                    except Exception as e:
+                        logger.error(f"Ошибка при обходе термина {term}: {e}")
+                        continue
+                    calls += 1
+                    fresh.add(term)
+                    METRICS.inc('crawler_calls_total')
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO crawl_state (term, crawled_at) VALUES (?, ?)', (term, time.time())
+                    )
+                    self.index.record_counts(channels)
+                    plan.observe(term, channels, scorer.matches(channels))
+                    await asyncio.sleep(self.call_interval)
+        finally:
+            self.index.prune_history(self.history_days)
+        return calls
+
+# Функция для получения обхода категорий (синглтон)
+def get_category_crawler():
+    global CATEGORY_CRAWLER
+    if CATEGORY_CRAWLER is None:
+        CATEGORY_CRAWLER = CategoryCrawler(
+            get_db(), get_channel_index(), CRAWL_HOURS, CRAWL_MAX_CALLS, CRAWL_CALL_INTERVAL,
+            CRAWL_REFINEMENTS, CRAWL_INTERVAL, CHANNEL_HISTORY_DAYS
+        )
+    return CATEGORY_CRAWLER
+
+# План глубокого поиска: термины плана, затем уточнения терминов, которые упёрлись в лимит ответа
+class DeepSearchPlan:
+    """Итератор терминов для fan_out_search, который дополняется по мере прихода ответов.
+
+    У contacts.SearchRequest нет смещения, поэтому следующая «страница» по термину - уточняющий запрос
+    «термин слово»: сначала с другими исходными терминами, затем с частыми начальными буквами слов
+    (глобальный поиск Telegram ищет по началу слов). Уточняются только термины, вернувшие не меньше
+    DEEP_SEARCH_MIN_HITS каналов, пока найдено меньше DEEP_SEARCH_TARGET каналов и пока уточнения
+    приносят новые релевантные каналы.
+    """
+
+    def __init__(self, terms, search_terms, max_calls=None, target=None, min_hits=None, min_yield=None,
+                 patience=None):
+        self.terms = terms
+        self.breadth = iter(terms)
+        # Термины плана без ответа: пока они есть, поиск, прерванный по дедлайну, считается частичным
+        self.unanswered = set(terms)
+        self.search_terms = [normalize_term(term) for term in search_terms]
+        self.max_calls = DEEP_SEARCH_MAX_CALLS if max_calls is None else max_calls
+        self.target = DEEP_SEARCH_TARGET if target is None else target
+        self.min_hits = DEEP_SEARCH_MIN_HITS if min_hits is None else min_hits
+        self.min_yield = DEEP_SEARCH_MIN_YIELD if min_yield is None else min_yield
+        self.patience = DEEP_SEARCH_PATIENCE if patience is None else patience
+        self.calls = 0
+        # Термины, которые можно уточнять: (термин, итератор уточняющих слов); обходятся по кругу
+        self.bases = deque()
+        self.base_of = {}
+        self.misses = {}
+        self.seen = set()
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        # Верхняя граница числа запросов: по ней fan_out_search выбирает число воркеров
+        return len(self.terms) + self.max_calls
+
+    def __next__(self):
+        term = next(self.breadth, None)
+        if term is not None:
+            return term
+        while self.bases and self.calls < self.max_calls and len(self.seen) < self.target:
+            base, words = self.bases.popleft()
+            if self.misses.get(base, 0) >= self.patience:
+                continue
+            word = next(words, None)
+            if word is None:
+                continue
+            self.bases.append((base, words))
+            refinement = f'{base} {word}'
+            self.base_of[refinement] = base
+            self.calls += 1
+            METRICS.inc('deep_search_calls_total')
+            return refinement
+        raise StopIteration
+
+    def _refinement_words(self, base):
+        for term in self.search_terms:
+            if term and term not in base and base not in term:
+                yield term
+        script = 'cyrillic' if any('а' <= char <= 'я' or char == 'ё' for char in base) else 'latin'
+        yield from DEEP_SEARCH_LETTERS[script]
+
+    def observe(self, term, channels, matches):
+        """Учитывает ответ по термину: насыщенный термин ставится в очередь на уточнение,
+        бесполезное уточнение приближает остановку уточнений этого термина"""
+        self.unanswered.discard(term)
+        fresh = 0
+        for channel, matched in zip(channels, matches):
+            username = channel['username'].lower()
+            if username not in self.seen:
+                self.seen.add(username)
+                fresh += matched
+        base = self.base_of.get(term)
+        if base is None:
+            if self.max_calls and len(channels) >= self.min_hits and ' ' not in term:
+                self.bases.append((term, self._refinement_words(term)))
+            return
+        METRICS.inc('deep_search_new_channels_total', fresh)
+        if fresh < max(1, self.min_yield * len(channels)):
+            self.misses[base] = self.misses.get(base, 0) + 1
+        else:
+            self.misses[base] = 0
+
+# Функция для параллельного выполнения поисковых запросов
+async def fan_out_search(client, terms, on_channels, is_full=None, concurrency=None, deadline=None):
+    """Выполняет SearchRequest по всем терминам с ограничением числа одновременных запросов.
+
+    terms - список терминов или DeepSearchPlan, который дополняется уточнениями по мере прихода ответов.
+    on_channels(term, channels) вызывается сразу по приходу каждого ответа. Как только is_full()
+    возвращает True, новые запросы не отправляются. Если все аккаунты в FloodWait, воркер ждёт
+    только когда ожидание укладывается в дедлайн. Возвращает False, если истёк дедлайн
+    или не осталось доступных аккаунтов.
+    """
+    concurrency = concurrency or SEARCH_CONCURRENCY
+    deadline = deadline if deadline is not None else SEARCH_DEADLINE
+    pending = iter(terms)
+    stopped = False
+    deadline_at = time.monotonic() + deadline
+    # Ответ по термину может пополнить DeepSearchPlan уточнениями, поэтому воркер без термина
+    # ждёт, пока остальные выполняют запросы, и завершается, только когда запросов в работе нет
+    progress = asyncio.Condition()
+    in_flight = 0
+
+    async def search(term):
+        nonlocal stopped
+        while True:
+            if stopped or (is_full and is_full()):
+                return False
+            try:
+                channels = await search_term(client, term)
+            except AccountsUnavailableError as e:
+                # Ждём освобождения аккаунта, только если ожидание укладывается в дедлайн
+                if time.monotonic() + e.seconds + 1 < deadline_at:
+                    await asyncio.sleep(e.seconds + 1)
+                    continue
+                if not stopped:
+                    logger.warning(f"Глобальный поиск остановлен: {e}")
+                stopped = True
+                return False
+            except Exception as e:
+                logger.error(f"Ошибка при поиске по термину {term}: {e}")
+                return True
+            on_channels(term, channels)
+            return True
 
-                    if relevant:
-                        channel_info = {
-                            'title': entity.title,
-                            'username': entity.username,
-                            'link': f'https://t.me/{entity.username}',
-                            'description': getattr(entity, 'about', 'Нет описания'),
-                            'participants_count': getattr(entity, 'participants_count', 0)
-                        }
+    async def worker():
+        nonlocal in_flight
+        # Все воркеры берут термины из общего итератора
+        while True:
+            term = next(pending, None)
+            if term is None:
+                async with progress:
+                    if not in_flight:
+                        return
+                    await progress.wait()
+                continue
+            in_flight += 1
+            try:
+                if not await search(term):
+                    return
+            finally:
+                in_flight -= 1
+                async with progress:
+                    progress.notify_all()
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(terms))))]
+    done, not_done = await asyncio.wait(workers, timeout=deadline)
+    for task in not_done:
+        task.cancel()
+    await asyncio.gather(*not_done, return_exceptions=True)
+    return not not_done and not stopped
+
+# Потоковый поиск каналов через Telethon API
+async def iter_search_channels(search_terms, phone_number):
+    """Асинхронный генератор: выдаёт текущий список найденных каналов по мере поступления ответов.
+
+    Последний выданный список - окончательный (SearchResults), отсортированный по релевантности;
+    его флаг partial означает, что поиск уложился в SEARCH_DEADLINE не полностью.
+    Вместо списка может быть выдано "auth_required" или "error", после чего генератор завершается.
+    """
+    results = ResultAccumulator(MAX_RESULTS)
+    budget = SearchBudget(SEARCH_DEADLINE)
+    partial = False
+    logger.debug(f"Начинаю поиск каналов по ключевым словам: {search_terms}")
 
-                        if not any(r['username'] == channel_info['username'] for r in results):
-                            results.append(channel_info)
+    client = await get_telethon_client(phone_number)
 
-                        if len(results) >= MAX_RESULTS:
-                            break
-        except Exception as e:
-            logger.error(f"Ошибка при поиске в диалогах: {e}")
+    if not await client.is_user_authorized():
+        logger.info("Пользователь не авторизован, требуется аутентификация")
+        METRICS.inc('searches_total', outcome='auth_required')
+        yield "auth_required"
+        return
 
-        # Прямой поиск по слову (для коротких терминов)
-        if len(results) < 10 and any(len(term) <= 5 for term in search_terms):
-            for term in search_terms:
-                if len(term) <= 5:
-                    try:
-                        # Используем более прямой поиск для коротких терминов
-                        async for dialog in client.iter_dialogs():
-                            if len(results) >= MAX_RESULTS:
-                                break
-
-                            entity = dialog.entity
-                            if hasattr(entity, 'broadcast') and entity.broadcast and hasattr(entity, 'username') and entity.username:
-                                if (term.lower() in entity.title.lower() or
-                                    (hasattr(entity, 'about') and entity.about and term.lower() in entity.about.lower())):
-
-                                    channel_info = {
-                                        'title': entity.title,
-                                        'username': entity.username,
-                                        'link': f'https://t.me/{entity.username}',
-                                        'description': getattr(entity, 'about', 'Нет описания'),
-                                        'participants_count': getattr(entity, 'participants_count', 0)
-                                    }
-
-                                    if not any(r['username'] == channel_info['username'] for r in results):
-                                        results.append(channel_info)
-                    except Exception as e:
-                        logger.error(f"Ошибка при прямом поиске по термину {term}: {e}")
+    # Снимок диалогов загружается в фоне, пока выполняется глобальный поиск
+    dialogs = get_dialog_snapshot()
+    dialogs.start(client)
+
+    fan_out_task = None
+    try:
+        # Планируем запросы: нормализованные термины и синонимы без регистровых вариантов
+        with METRICS.timer('search_stage_seconds', stage='expansion'):
+            plan = plan_search_terms(search_terms)
+        expanded_terms = plan.terms
+        METRICS.observe('search_terms_planned', len(expanded_terms), Metrics.COUNT_BUCKETS)
+        logger.debug(f"Расширенные поисковые термины: {expanded_terms} (сэкономлено запросов: {plan.saved})")
+        term_signatures = {}
+
+        # Оценка релевантности по исходным терминам, общая для всех этапов поиска
+        # Опечатки, формы слов и транслитерацию находим по словарю известных каналов, а не запросами к API
+        index = get_channel_index()
+        with METRICS.timer('search_stage_seconds', stage='fuzzy'):
+            variants = index.vocabulary.variants(expanded_terms)
+        user_terms = {normalize_term(term) for term in search_terms}
+        scorer = RelevanceScorer(
+            list(search_terms) + [word for term in user_terms for word in variants.get(term, ())]
+        )
 
-        logger.info(f"Поиск завершен. Найдено каналов: {len(results)}")
+        # Добавление найденных каналов в результаты с проверкой релевантности всей пачки сразу
+        def merge_channels(channels):
+            # Здесь нужен только факт совпадения; полная оценка считается один раз при итоговом ранжировании
+            matches = scorer.matches(channels)
+            for channel_info, matched in zip(channels, matches):
+                # Каналы с совпадением исходных терминов попадают в начало списка
+                results.add(channel_info, matched=matched)
+            return matches
+
+        # Сначала отвечаем из локального индекса известных каналов
+        local_terms = expanded_terms + [word for words in variants.values() for word in words]
+        with METRICS.timer('search_stage_seconds', stage='local_index'):
+            merge_channels(index.search(local_terms, MAX_RESULTS))
+        logger.debug(f"Найдено в локальном индексе: {len(results)}")
+        if len(results):
+            yield results.results()
+
+        # Глобальный поиск Telegram нужен, только если локальных результатов недостаточно
+        if len(results) < LOCAL_INDEX_ENOUGH:
+            # Ответы объединяются в фоновой задаче, а генератор выдаёт результаты после каждого из них
+            updates = asyncio.Queue()
+
+            # Обработка ответа на один поисковый запрос, вызывается по мере поступления ответов
+            def merge_term_channels(term, channels):
+                term_signatures[term] = frozenset(channel['username'].lower() for channel in channels)
+                deep_plan.observe(term, channels, merge_channels(channels))
+                updates.put_nowait(term)
+
+            # После терминов плана уточняются те, по которым глобальный поиск упёрся в лимит ответа
+            deep_plan = DeepSearchPlan(expanded_terms, search_terms)
+
+            async def run_fan_out():
+                try:
+                    pool = get_client_pool()
+                    complete = await fan_out_search(
+                        pool, deep_plan, merge_term_channels,
+                        is_full=results.is_full,
+                        deadline=budget.stage_timeout('global')
+                    )
+                    # Недоделанные уточнения не делают результат частичным
+                    return complete or not deep_plan.unanswered
+                finally:
+                    updates.put_nowait(None)
+
+            stage_started = time.perf_counter()
+            fan_out_task = asyncio.create_task(run_fan_out())
+            finished = False
+            while not finished:
+                known = len(results)
+                finished = await updates.get() is None
+                # Несколько ответов, пришедших подряд, выдаём одним обновлением
+                while not finished and not updates.empty():
+                    finished = updates.get_nowait() is None
+                if len(results) > known:
+                    yield results.results()
+
+            complete = await fan_out_task
+            METRICS.observe('search_stage_seconds', time.perf_counter() - stage_started, stage='global')
+            if not complete and not results.is_full():
+                partial = True
+                logger.warning(f"Глобальный поиск завершен не полностью, найдено каналов: {len(results)}")
+            remember_duplicate_terms(plan, term_signatures)
+
+        # Дополнительный поиск среди каналов из диалогов аккаунта: по снимку в памяти, без запросов к API.
+        # Снимок охватывает все диалоги, поэтому отдельный проход для коротких терминов не нужен.
+        # Если снимок ещё ни разу не загружен, ждём его не дольше оставшегося бюджета
+        stage_started = time.perf_counter()
+        if not dialogs.ready.is_set():
+            try:
+                await asyncio.wait_for(dialogs.ready.wait(), timeout=budget.stage_timeout('dialogs'))
+            except asyncio.TimeoutError:
+                partial = True
+                logger.warning("Снимок диалогов не успел загрузиться, поиск по диалогам пропущен")
+        for channel_info in dialogs.match(scorer):
+            if results.is_full():
+                break
+            results.add(channel_info)
+        METRICS.observe('search_stage_seconds', time.perf_counter() - stage_started, stage='dialogs')
+
+        # Итоговый порядок - по оценке релевантности
+        with METRICS.timer('search_stage_seconds', stage='ranking'):
+            final_results = SearchResults(scorer.rank(results.results()), partial=partial)
+            index.add(final_results)
+        METRICS.observe('search_duration_seconds', budget.elapsed())
+        METRICS.observe('search_results', len(final_results), Metrics.COUNT_BUCKETS)
+        METRICS.inc('searches_total', outcome='partial' if partial else 'complete')
+        logger.info(
+            f"Поиск завершен за {budget.elapsed():.2f} сек. Найдено каналов: {len(final_results)}"
+            f"{' (частичные результаты)' if partial else ''}"
+        )
     except Exception as e:
         logger.error(f"Ошибка при поиске каналов: {e}")
-        return "error"
+        METRICS.inc('searches_total', outcome='error')
+        yield "error"
+        return
+    finally:
+        # Если потребитель прекратил чтение раньше времени, останавливаем запросы к API
+        if fan_out_task is not None and not fan_out_task.done():
+            fan_out_task.cancel()
+
+    yield final_results
 
+# Функция для поиска каналов через Telethon API: возвращает окончательный список
+async def search_channels(search_terms, phone_number):
+    results = []
+    async for results in iter_search_channels(search_terms, phone_number):
+        if isinstance(results, str):
+            break
     return results
 
 # Команда /start
@@ -296,7 +2170,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "🔍 *Как это работает:*\n"
         "• Отправьте мне ключевые слова через запятую\n"
         "• Я найду для вас интересные каналы\n"
-        "• Используйте кнопки для навигации по результатам\n\n"
+        "• Используйте кнопки для навигации по результатам\n"
+        "• /export - все найденные каналы одним файлом (CSV или JSONL)\n\n"
         "📝 *Пример запроса:*\n"
         "`программирование, технологии, новости`\n\n"
         "💡 *Совет:* Чем конкретнее термины, тем лучше результаты!\n\n"
@@ -321,13 +2196,14 @@ async def get_search_terms(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_html(error_message)
         return SEARCH_TERMS
 
-    context.user_data['search_terms'] = search_terms
+    store = get_session_store()
+    session = store.create(update.effective_user.id, search_terms)
 
     # Красивое сообщение о начале поиска
     search_message = (
         "🔍 *Запускаю поиск каналов...*\n\n"
         f"🎯 *Поисковые термины:* `{', '.join(search_terms)}`\n\n"
-        "⏳ Это может занять до минуты, пожалуйста подождите...\n"
+        "⏳ Первые каналы появятся через несколько секунд...\n"
         "🔄 Сканирую базу Telegram каналов..."
     )
     search_msg = await update.message.reply_html(search_message)
@@ -335,13 +2211,46 @@ async def get_search_terms(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     phone_number = ADMIN_PHONE
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
 
-    results = await search_channels(search_terms, phone_number)
+    # Первая страница показывается, как только набралось достаточно каналов,
+    # дальше сообщение с результатами обновляется не чаще PROGRESS_EDIT_INTERVAL секунд
+    results = []
+    shown = False
+    last_edit = 0
+    session.in_progress = True
+    try:
+        with sampled_profile('search'):
+            async for results in iter_search_channels(search_terms, phone_number):
+                if isinstance(results, str):
+                    break
+                # В сессию попадает то, что видит пользователь: листание идет по последнему показанному списку
+                if not shown and len(results) >= CHANNELS_PER_PAGE:
+                    store.set_results(session, results)
+                    await delete_search_message(context, search_msg)
+                    await show_channels_buttons(update, context, session)
+                    shown = True
+                    last_edit = time.monotonic()
+                elif shown and time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL:
+                    store.set_results(session, results)
+                    # Без update сообщение с результатами редактируется по сохранённому ID
+                    await show_channels_buttons(None, context, session)
+                    last_edit = time.monotonic()
+    finally:
+        session.in_progress = False
+
+    session.partial = getattr(results, 'partial', False)
+    if shown:
+        if results == "error":
+            logger.warning("Поиск завершился ошибкой, оставляем уже показанные результаты")
+        else:
+            store.set_results(session, results)
+        store.save(session)
+        get_channel_enricher().submit(session.results)
+        # Окончательный порядок и количество каналов
+        await show_channels_buttons(None, context, session)
+        return SEARCH_TERMS
 
     # Удаляем сообщение о поиске
-    try:
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=search_msg.message_id)
-    except:
-        pass
+    await delete_search_message(context, search_msg)
 
     if results == "auth_required":
         auth_message = (
@@ -374,14 +2283,107 @@ async def get_search_terms(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         await update.message.reply_html(no_results_message)
     else:
-        context.user_data['search_results'] = results
-        await show_channels_buttons(update, context)
+        store.set_results(session, results)
+        store.save(session)
+        get_channel_enricher().submit(session.results)
+        await show_channels_buttons(update, context, session)
 
     return SEARCH_TERMS
 
+# Удаление сообщения о ходе поиска
+async def delete_search_message(context, search_msg):
+    try:
+        await context.bot.delete_message(chat_id=search_msg.chat_id, message_id=search_msg.message_id)
+    except:
+        pass
+
+# Текст и клавиатура текущей страницы списка; страница собирается один раз на набор результатов
+def render_channels_page(session):
+    key = ('list', session.page, session.in_progress, session.partial)
+    payload = session.renders.get(key)
+    METRICS.inc('render_cache_total', view='list', result='miss' if payload is None else 'hit')
+    if payload is None:
+        started = time.perf_counter()
+        page = session.page
+        results = session.results
+        channels_per_page = CHANNELS_PER_PAGE
+        total_pages = (len(results) + channels_per_page - 1) // channels_per_page
+
+        start_idx = page * channels_per_page
+        end_idx = min(start_idx + channels_per_page, len(results))
+        current_channels = results[start_idx:end_idx]
+
+        # Красивое сообщение с результатами
+        message_text = (
+            f"🎉 *Найдено {len(results)} каналов!*\n\n"
+            f"📄 Страница {page + 1} из {total_pages}\n"
+            f"🔽 Выберите канал для перехода:"
+        )
+        if session.in_progress:
+            message_text += "\n\n⏳ Поиск продолжается, список будет дополнен..."
+        elif session.partial:
+            message_text += "\n\n⏱ Показаны частичные результаты: поиск ограничен по времени"
+
+        keyboard = []
+
+        # Кнопки каналов
+        for i, channel in enumerate(current_channels, 1):
+            title = channel.title
+            if len(title) > 35:
+                title = title[:35] + "..."
+
+            # Добавляем информацию о подписчиках если есть
+            subscribers_info = ""
+            if channel.participants_count > 0:
+                count = channel.participants_count
+                if count >= 1000000:
+                    subscribers_info = f" ({count//1000000}M)"
+                elif count >= 1000:
+                    subscribers_info = f" ({count//1000}K)"
+                else:
+                    subscribers_info = f" ({count})"
+
+            button_text = f"{start_idx + i}. 📢 {title}{subscribers_info}"
+            keyboard.append([InlineKeyboardButton(button_text, url=channel.link)])
+
+        # Разделительная линия
+        keyboard.append([InlineKeyboardButton("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━", callback_data="ignore")])
+
+        # Навигационные кнопки
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data="prev_page"))
+
+        nav_buttons.append(InlineKeyboardButton(f"📄 {page + 1}/{total_pages}", callback_data="ignore"))
+
+        if end_idx < len(results):
+            nav_buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data="next_page"))
+
+        keyboard.append(nav_buttons)
+
+        # Дополнительные кнопки
+        keyboard.append([
+            InlineKeyboardButton("🔍 Новый поиск", callback_data="new_search"),
+            InlineKeyboardButton("ℹ️ Подробнее", callback_data="detailed_view")
+        ])
+
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        payload = session.renders[key] = (message_text, reply_markup)
+        METRICS.observe('search_stage_seconds', time.perf_counter() - started, stage='render')
+    return payload
+
+# Сообщение, в котором показывается страница: нажатая кнопка или сохраненное сообщение с результатами
+def shown_message_id(update, session):
+    query = getattr(update, 'callback_query', None)
+    if query is not None and query.message is not None:
+        return query.message.message_id
+    return session.message_id
+
 # Функция для отображения каналов с пагинацией
-async def show_channels_buttons(update, context):
-    results = context.user_data.get('search_results', [])
+async def show_channels_buttons(update, context, session=None):
+    if session is None:
+        session = get_session_store().get(update.effective_user.id)
+    results = session.results if session else []
 
     if not results:
         error_message = "❌ Нет результатов для отображения"
@@ -391,76 +2393,20 @@ async def show_channels_buttons(update, context):
             await update.callback_query.edit_message_text(error_message, parse_mode='HTML')
         return
 
-    if 'buttons_page' not in context.user_data:
-        context.user_data['buttons_page'] = 0
-
-    page = context.user_data['buttons_page']
-    channels_per_page = 6
-    total_pages = (len(results) + channels_per_page - 1) // channels_per_page
-
-    start_idx = page * channels_per_page
-    end_idx = min(start_idx + channels_per_page, len(results))
-    current_channels = results[start_idx:end_idx]
-
-    # Красивое сообщение с результатами
-    message_text = (
-        f"🎉 *Найдено {len(results)} каналов!*\n\n"
-        f"📄 Страница {page + 1} из {total_pages}\n"
-        f"🔽 Выберите канал для перехода:"
-    )
-
-    keyboard = []
-
-    # Кнопки каналов
-    for i, channel in enumerate(current_channels, 1):
-        title = channel['title']
-        if len(title) > 35:
-            title = title[:35] + "..."
-
-        # Добавляем информацию о подписчиках если есть
-        subscribers_info = ""
-        if channel.get('participants_count', 0) > 0:
-            count = channel['participants_count']
-            if count >= 1000000:
-                subscribers_info = f" ({count//1000000}M)"
-            elif count >= 1000:
-                subscribers_info = f" ({count//1000}K)"
-            else:
-                subscribers_info = f" ({count})"
-
-        button_text = f"{start_idx + i}. 📢 {title}{subscribers_info}"
-        keyboard.append([InlineKeyboardButton(button_text, url=channel['link'])])
-
-    # Разделительная линия
-    keyboard.append([InlineKeyboardButton("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━", callback_data="ignore")])
-
-    # Навигационные кнопки
-    nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data="prev_page"))
-
-    nav_buttons.append(InlineKeyboardButton(f"📄 {page + 1}/{total_pages}", callback_data="ignore"))
-
-    if end_idx < len(results):
-        nav_buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data="next_page"))
-
-    keyboard.append(nav_buttons)
-
-    # Дополнительные кнопки
-    keyboard.append([
-        InlineKeyboardButton("🔍 Новый поиск", callback_data="new_search"),
-        InlineKeyboardButton("ℹ️ Подробнее", callback_data="detailed_view")
-    ])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    message_text, reply_markup = payload = render_channels_page(session)
+    new_message = hasattr(update, 'message') and update.message
+    if not new_message and (shown_message_id(update, session), payload) == session.shown:
+        # Страница не изменилась - лишний edit_message_text Telegram все равно отклонит
+        METRICS.inc('bot_api_skipped_edits_total')
+        return
 
     try:
         # Определяем, это новое сообщение или редактирование существующего
-        if hasattr(update, 'message') and update.message:
+        if new_message:
             # Это новое сообщение от команды /start или поиска
             message = await update.message.reply_html(message_text, reply_markup=reply_markup)
-            context.user_data['results_message_id'] = message.message_id
-            context.user_data['chat_id'] = update.message.chat_id
+            session.message_id = message.message_id
+            session.chat_id = update.message.chat_id
         elif hasattr(update, 'callback_query'):
             # Это callback query, редактируем существующее сообщение
             await update.callback_query.edit_message_text(
@@ -470,8 +2416,8 @@ async def show_channels_buttons(update, context):
             )
         else:
             # Прямое обновление сообщения по ID, если доступен
-            chat_id = context.user_data.get('chat_id')
-            message_id = context.user_data.get('results_message_id')
+            chat_id = session.chat_id
+            message_id = session.message_id
             if chat_id and message_id:
                 await context.bot.edit_message_text(
                     text=message_text,
@@ -491,8 +2437,12 @@ async def show_channels_buttons(update, context):
                         reply_markup=reply_markup,
                         parse_mode='HTML'
                     )
-                    context.user_data['results_message_id'] = message.message_id
-                    context.user_data['chat_id'] = chat_id
+                    session.message_id = message.message_id
+                    session.chat_id = chat_id
+        session.shown = (shown_message_id(update, session), payload)
+    except RetryAfter as e:
+        # Ограничитель уже исчерпал повторы - новое сообщение упрется в тот же лимит
+        logger.warning(f"Не удалось показать каналы из-за лимита Bot API: {e}")
     except Exception as e:
         logger.error(f"Ошибка при отображении каналов: {e}")
         # Fallback: пытаемся получить chat_id из разных источников
@@ -502,8 +2452,8 @@ async def show_channels_buttons(update, context):
                 chat_id = update.callback_query.message.chat_id
             elif hasattr(update, 'message'):
                 chat_id = update.message.chat_id
-            elif context.user_data.get('chat_id'):
-                chat_id = context.user_data.get('chat_id')
+            elif session.chat_id:
+                chat_id = session.chat_id
 
             if chat_id:
                 message = await context.bot.send_message(
@@ -512,8 +2462,9 @@ async def show_channels_buttons(update, context):
                     reply_markup=reply_markup,
                     parse_mode='HTML'
                 )
-                context.user_data['results_message_id'] = message.message_id
-                context.user_data['chat_id'] = chat_id
+                session.message_id = message.message_id
+                session.chat_id = chat_id
+                session.shown = (message.message_id, payload)
         except Exception as e2:
             logger.error(f"Критическая ошибка при отправке сообщения: {e2}")
 
@@ -521,21 +2472,29 @@ async def show_channels_buttons(update, context):
 async def handle_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    store = get_session_store()
+    session = store.get(update.effective_user.id)
 
     try:
-        if query.data == "prev_page":
-            context.user_data['buttons_page'] = max(0, context.user_data.get('buttons_page', 0) - 1)
-            await show_channels_buttons(update, context)  # Передаем весь update, а не только query
+        if query.data in ("prev_page", "next_page") and session is None:
+            await show_channels_buttons(update, context)
+
+        elif query.data == "prev_page":
+            session.page = max(0, session.page - 1)
+            store.save_page(session)
+            await show_channels_buttons(update, context, session)  # Передаем весь update, а не только query
 
         elif query.data == "next_page":
-            results = context.user_data.get('search_results', [])
-            channels_per_page = 6
+            results = session.results
+            channels_per_page = CHANNELS_PER_PAGE
             max_page = (len(results) - 1) // channels_per_page if results else 0
-            context.user_data['buttons_page'] = min(max_page, context.user_data.get('buttons_page', 0) + 1)
-            await show_channels_buttons(update, context)  # Передаем весь update, а не только query
+            session.page = min(max_page, session.page + 1)
+            store.save_page(session)
+            await show_channels_buttons(update, context, session)  # Передаем весь update, а не только query
 
         elif query.data == "new_search":
             context.user_data.clear()
+            store.delete(update.effective_user.id)
             welcome_msg = (
                 "🔍 *Новый поиск*\n\n"
                 "Введите новые ключевые слова для поиска каналов:"
@@ -543,13 +2502,13 @@ async def handle_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(welcome_msg, parse_mode='HTML')
 
         elif query.data == "detailed_view":
-            await show_detailed_results(update, context)  # Передаем весь update, а не только query
+            await show_detailed_results(update, context, session)  # Передаем весь update, а не только query
 
         elif query.data == "back_to_list":
             # Проверяем наличие результатов
-            if context.user_data.get('search_results'):
-                logger.info("Возвращаемся к списку каналов")
-                await show_channels_buttons(update, context)  # Передаем весь update, а не только query
+            if session and session.results:
+                logger.debug("Возвращаемся к списку каналов")
+                await show_channels_buttons(update, context, session)  # Передаем весь update, а не только query
             else:
                 logger.warning("Попытка вернуться к списку без сохраненных результатов")
                 await query.edit_message_text(
@@ -569,26 +2528,30 @@ async def handle_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
-# Показать подробные результаты
-async def show_detailed_results(update, context):
-    # Получаем query из update
-    query = update.callback_query if hasattr(update, 'callback_query') else update
+# Подробная страница: собирается из частей один раз на набор результатов и номер страницы
+def render_detailed_page(session):
+    key = ('details', session.page)
+    payload = session.renders.get(key)
+    METRICS.inc('render_cache_total', view='details', result='miss' if payload is None else 'hit')
+    if payload is not None:
+        return payload
+    started = time.perf_counter()
 
-    results = context.user_data.get('search_results', [])
-    page = context.user_data.get('buttons_page', 0)
-    channels_per_page = 6
+    results = session.results
+    page = session.page
+    channels_per_page = CHANNELS_PER_PAGE
 
     start_idx = page * channels_per_page
     end_idx = min(start_idx + channels_per_page, len(results))
     current_channels = results[start_idx:end_idx]
 
-    message_text = f"📊 *Подробная информация (страница {page + 1}):*\n\n"
+    parts = [f"📊 *Подробная информация (страница {page + 1}):*\n\n"]
 
     for i, channel in enumerate(current_channels, 1):
-        message_text += f"*{start_idx + i}. {channel['title']}*\n"
+        parts.append(f"*{start_idx + i}. {channel.title}*\n")
 
         # Информация о подписчиках
-        participants = channel.get('participants_count', 0)
+        participants = channel.participants_count
         if participants > 0:
             if participants >= 1000000:
                 participants_str = f"{participants // 1000000}.{(participants % 1000000) // 100000}M"
@@ -596,29 +2559,42 @@ async def show_detailed_results(update, context):
                 participants_str = f"{participants // 1000}.{(participants % 1000) // 100}K"
             else:
                 participants_str = str(participants)
-            message_text += f"👥 Подписчиков: {participants_str}\n"
+            parts.append(f"👥 Подписчиков: {participants_str}\n")
         else:
-            message_text += f"👥 Подписчиков: Неизвестно\n"
+            parts.append("👥 Подписчиков: Неизвестно\n")
 
         # Безопасно обрабатываем описание
-        desc = channel.get('description', 'Нет описания')
+        desc = channel.description
         if desc and desc != 'Нет описания':
             if len(desc) > 150:
                 desc = desc[:150] + "..."
             # Экранируем специальные символы для HTML
-            desc = desc.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-            message_text += f"📝 Описание: {desc}\n"
+            parts.append(f"📝 Описание: {html.escape(desc, quote=False)}\n")
         else:
-            message_text += f"📝 Описание: Нет описания\n"
+            parts.append("📝 Описание: Нет описания\n")
 
-        message_text += f"🔗 Ссылка: {channel['link']}\n\n"
+        parts.append(f"🔗 Ссылка: {channel.link}\n\n")
 
     # Добавляем информацию о навигации
     total_pages = (len(results) + channels_per_page - 1) // channels_per_page
-    message_text += f"📄 Показана страница {page + 1} из {total_pages}"
+    parts.append(f"📄 Показана страница {page + 1} из {total_pages}")
 
     keyboard = [[InlineKeyboardButton("🔙 Назад к списку", callback_data="back_to_list")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    payload = session.renders[key] = (''.join(parts), InlineKeyboardMarkup(keyboard))
+    METRICS.observe('search_stage_seconds', time.perf_counter() - started, stage='render')
+    return payload
+
+# Показать подробные результаты
+async def show_detailed_results(update, context, session=None):
+    # Получаем query из update
+    query = update.callback_query if hasattr(update, 'callback_query') else update
+
+    if session is None:
+        session = get_session_store().get(update.effective_user.id) or SearchSession(update.effective_user.id)
+    message_text, reply_markup = payload = render_detailed_page(session)
+    if (shown_message_id(update, session), payload) == session.shown:
+        # Повторное нажатие «Подробнее» - сообщение уже показывает эту страницу
+        return
 
     try:
         if hasattr(query, 'edit_message_text'):
@@ -626,6 +2602,9 @@ async def show_detailed_results(update, context):
         else:
             # Если у нас есть только callback_query в обновлении
             await query.callback_query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='HTML')
+        session.shown = (shown_message_id(update, session), payload)
+    except RetryAfter as e:
+        logger.warning(f"Не удалось показать подробности из-за лимита Bot API: {e}")
     except Exception as e:
         logger.error(f"Ошибка при показе подробностей: {e}")
         # Fallback без форматирования HTML
@@ -645,8 +2624,8 @@ async def show_detailed_results(update, context):
                     chat_id = query.message.chat_id
                 elif hasattr(query, 'callback_query') and hasattr(query.callback_query, 'message'):
                     chat_id = query.callback_query.message.chat_id
-                elif context.user_data.get('chat_id'):
-                    chat_id = context.user_data.get('chat_id')
+                elif session and session.chat_id:
+                    chat_id = session.chat_id
 
                 if chat_id:
                     await context.bot.send_message(
@@ -657,6 +2636,111 @@ async def show_detailed_results(update, context):
             except Exception as e3:
                 logger.error(f"Не удалось отправить подробную информацию: {e3}")
 
+# Порции каналов из результатов поиска для выгрузки
+def session_export_chunks(results, chunk_size):
+    for start in range(0, len(results), chunk_size):
+        yield [record.as_dict() for record in results[start:start + chunk_size]]
+
+# Порции каналов из локального каталога по запросу для выгрузки
+def catalog_export_chunks(search_terms, limit, chunk_size):
+    index = get_channel_index()
+    terms = [normalize_term(term) for term in search_terms]
+    variants = index.vocabulary.variants(terms)
+    terms += [word for words in variants.values() for word in words]
+    return index.iter_search(terms, limit, chunk_size)
+
+# Экранирование ячейки CSV: название или описание канала не должно выполниться как формула
+def csv_cell(value):
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+# Запись выгрузки порциями в файл
+async def write_export(chunks, fmt, file, max_bytes=None):
+    """Пишет каналы в CSV или JSONL по мере получения порций и отдает цикл событий между порциями.
+
+    В памяти одновременно только одна порция; сам файл - SpooledTemporaryFile, который после
+    EXPORT_SPOOL_SIZE байт переносится на диск. Как только файл достигает max_bytes, запись
+    останавливается после текущей порции, а остальные порции итератора chunks остаются для
+    следующего файла. Возвращает число записанных каналов.
+    """
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        # BOM нужен, чтобы Excel открыл кириллицу в UTF-8 без ручного выбора кодировки
+        buffer.write('\ufeff')
+        writer.writerow(EXPORT_FIELDS)
+    count = 0
+    for chunk in chunks:
+        for channel in chunk:
+            if channel['description'] == 'Нет описания':
+                channel['description'] = ''
+            if fmt == 'csv':
+                writer.writerow([csv_cell(channel[field]) for field in EXPORT_FIELDS])
+            else:
+                buffer.write(json.dumps({field: channel[field] for field in EXPORT_FIELDS}, ensure_ascii=False))
+                buffer.write('\n')
+        count += len(chunk)
+        file.write(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+        await asyncio.sleep(0)
+        if max_bytes and file.tell() >= max_bytes:
+            break
+    return count
+
+# Команда /export: выгрузка всех найденных каналов или каталога по запросу файлом
+async def export_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args or [])
+    fmt = args.pop(0).lower() if args and args[0].lower() in ('csv', 'jsonl') else 'csv'
+    search_terms = [term.strip() for term in ' '.join(args).split(',') if term.strip()]
+
+    if search_terms:
+        chunks = catalog_export_chunks(search_terms, EXPORT_MAX_ROWS, EXPORT_CHUNK_SIZE)
+        caption = f"📦 Каталог по запросу: {', '.join(search_terms)}"
+    else:
+        session = get_session_store().get(update.effective_user.id)
+        if session is None or not session.results:
+            await update.message.reply_html(
+                "❌ Нет результатов для выгрузки\n\n"
+                "🔍 Сначала выполните поиск или укажите запрос для выгрузки из каталога:\n"
+                "<code>/export csv новости, спорт</code>"
+            )
+            return
+        # Список результатов заменяется целиком при обновлении, поэтому выгружается тот, что есть сейчас
+        chunks = session_export_chunks(session.results[:EXPORT_MAX_ROWS], EXPORT_CHUNK_SIZE)
+        caption = f"📦 Результаты поиска: {', '.join(session.terms)}"
+
+    try:
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='upload_document')
+        # Документы не больше EXPORT_FILE_MAX_BYTES: при отправке каждый целиком читается в память
+        chunks = iter(chunks)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        total = parts = 0
+        while True:
+            with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file:
+                count = await write_export(chunks, fmt, file, EXPORT_FILE_MAX_BYTES)
+                if not count:
+                    break
+                parts += 1
+                total += count
+                file.seek(0)
+                # PTB все равно читает документ целиком; к тому же у файла в памяти нет имени (name=None),
+                # и InputFile не смог бы его прочитать сам
+                await update.message.reply_document(
+                    document=file.read(),
+                    filename=f"channels-{stamp}.{fmt}" if parts == 1 else f"channels-{stamp}-{parts}.{fmt}",
+                    caption=f"{caption}\nКаналов: {count}" if parts == 1 else f"{caption}\nЧасть {parts}, каналов: {count}"
+                )
+        if not total:
+            await update.message.reply_html("😔 Каналы не найдены")
+            return
+        METRICS.inc('exports_total', format=fmt)
+        logger.info(f"Выгрузка {fmt}: {total} каналов в {parts} файлах для пользователя {update.effective_user.id}")
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке каналов: {e}")
+        await update.message.reply_html("❌ Не удалось подготовить выгрузку, попробуйте позже")
+
 # Обработчик кода верификации
 async def get_verification_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     code = update.message.text.strip()
@@ -672,12 +2756,18 @@ async def get_verification_code(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_html("✅ Успешная авторизация! Повторяю поиск...")
 
         # Повторяем поиск после авторизации
-        search_terms = context.user_data.get('search_terms', [])
+        store = get_session_store()
+        session = store.get(update.effective_user.id)
+        search_terms = session.terms if session else []
         if search_terms:
             results = await search_channels(search_terms, phone_number)
-            if results and results != "error":
-                context.user_data['search_results'] = results
-                await show_channels_buttons(update, context)
+            if results and results != "error" and results != "auth_required":
+                store.set_results(session, results)
+                session.page = 0
+                session.partial = getattr(results, 'partial', False)
+                store.save(session)
+                get_channel_enricher().submit(session.results)
+                await show_channels_buttons(update, context, session)
             else:
                 await update.message.reply_html("😔 Каналы не найдены")
 
@@ -693,9 +2783,238 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_html("❌ Поиск отменен. Используйте /start для нового поиска.")
     return ConversationHandler.END
 
-def main():
-    """Запуск бота"""
-    application = Application.builder().token(BOT_TOKEN).build()
+# Интерактивная авторизация дополнительного аккаунта пула: python bot.py login +79001234567
+async def login_account(phone_number):
+    client = TelegramClient('session_' + phone_number, API_ID, API_HASH)
+    await client.start(phone=phone_number)
+    logger.info(f"Аккаунт {phone_number} авторизован")
+    await client.disconnect()
+
+# Подключение Telethon в том же цикле событий, в котором работает python-telegram-bot
+async def on_startup(application):
+    global METRICS_SERVER
+    pool = get_client_pool()
+    await pool.connect()
+    pool.start(POOL_RECONNECT_INTERVAL)
+    run_in_background(get_channel_index().load_vocabulary())
+    get_channel_enricher().start(pool)
+    get_category_crawler().start(pool)
+    METRICS.gauge('sessions_in_memory', lambda: len(get_session_store().sessions))
+    METRICS.gauge('enrich_queue_length', lambda: len(get_channel_enricher().queue))
+    METRICS.gauge('telegram_accounts_available', lambda: sum(a.available(time.time()) for a in pool.accounts))
+    METRICS.gauge('background_tasks', lambda: len(BACKGROUND_TASKS))
+    if METRICS_PORT:
+        METRICS_SERVER = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+        logger.info(f"Метрики доступны на http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    if ADMIN_PHONE:
+        client = await get_telethon_client(ADMIN_PHONE)
+        if await client.is_user_authorized():
+            get_dialog_snapshot().start(client)
+    logger.info(f"Telethon подключен, аккаунтов в пуле: {len(CLIENT_POOL.accounts)}")
+
+# Корректная остановка: фоновые задачи, клиенты Telethon и база данных
+async def on_shutdown(application):
+    if METRICS_SERVER is not None:
+        METRICS_SERVER.close()
+        await METRICS_SERVER.wait_closed()
+    if DIALOG_SNAPSHOT is not None:
+        await DIALOG_SNAPSHOT.stop()
+    if CHANNEL_ENRICHER is not None:
+        await CHANNEL_ENRICHER.stop()
+    if CATEGORY_CRAWLER is not None:
+        await CATEGORY_CRAWLER.stop()
+    if CLIENT_POOL is not None:
+        await CLIENT_POOL.stop()
+    tasks = list(BACKGROUND_TASKS) + list(IN_FLIGHT_TERMS.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for client in CLIENTS.values():
+        await client.disconnect()
+    CLIENTS.clear()
+    if DB is not None:
+        DB.close()
+    logger.info("Бот остановлен")
+
+# Параллельная обработка обновлений с сохранением порядка для каждого пользователя
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Разные пользователи обрабатываются параллельно, обновления одного пользователя - по очереди.
+
+    У пользователя две очереди: сообщения (и кнопки, меняющие состояние диалога) и навигация
+    по результатам, поэтому листание страниц не ждет, пока идет долгий поиск.
+    """
+    __slots__ = ('_lanes', '_slots')
+
+    # Лимит базового класса: сам по себе он ничего не ограничивает, слоты обработки выдает _slots
+    BASE_LIMIT = 2 ** 20
+
+    def __init__(self, max_concurrent_updates):
+        if max_concurrent_updates < 1:
+            raise ValueError('max_concurrent_updates должен быть положительным')
+        super().__init__(self.BASE_LIMIT)
+        self._lanes = {}
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+
+    @staticmethod
+    def lane_key(update):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            return None
+        query = update.callback_query
+        lane = 'navigation' if query and query.data in NAVIGATION_CALLBACKS else 'conversation'
+        return user.id, lane
+
+    async def do_process_update(self, update, coroutine):
+        # Очередь пользователя занимается до слота обработки, иначе ожидающие своей очереди
+        # обновления держали бы слоты других пользователей
+        key = self.lane_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        # [замок, число ожидающих]; запись удаляется, когда очередь пользователя пуста
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = [asyncio.Lock(), 0]
+        lane[1] += 1
+        try:
+            async with lane[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            lane[1] -= 1
+            if not lane[1]:
+                del self._lanes[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._lanes.clear()
+
+# Ограничитель исходящих запросов к Bot API: лимиты Telegram на чат и на бота в целом
+class OutboundRateLimiter(BaseRateLimiter):
+    """Распределяет сообщения по времени так, чтобы не получать 429 Too Many Requests.
+
+    Лимиты считаются по алгоритму GCRA: у каждого чата и у бота в целом есть «теоретическое время»
+    следующего сообщения, запрос ждет до момента, когда его пропускают оба. Несколько правок одного
+    сообщения, ожидающих очереди, сливаются в одну - уходит только последняя версия. При 429
+    отправка всех сообщений приостанавливается на retry_after и запрос повторяется.
+    """
+    __slots__ = ('global_interval', 'chat_interval', 'group_interval', 'chat_burst', 'max_retries',
+                 '_global_tat', '_chat_tat', '_paused_until', '_pending_edits')
+
+    def __init__(self, global_rate, chat_rate, group_rate, chat_burst, max_retries):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = 1 / chat_rate
+        self.group_interval = 1 / group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global_tat = 0.0
+        self._chat_tat = {}
+        self._paused_until = 0.0
+        self._pending_edits = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chat_tat.clear()
+
+    async def _wait_turn(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # Личные чаты - 1 сообщение в секунду с небольшим запасом на всплеск, группы - 20 в минуту
+        private = isinstance(chat_id, int) and chat_id > 0
+        interval = self.chat_interval if private else self.group_interval
+        tolerance = interval * (self.chat_burst - 1) if private else 0
+        tat = self._chat_tat.get(chat_id, now)
+        at = max(now, tat - tolerance, self._global_tat, self._paused_until)
+        self._chat_tat[chat_id] = max(tat, at) + interval
+        self._global_tat = at + self.global_interval
+        if len(self._chat_tat) > 10000:
+            # Чаты, чей лимит давно восстановился, не нужно помнить
+            self._chat_tat = {key: value for key, value in self._chat_tat.items() if value > now}
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _send(self, callback, args, kwargs, endpoint, chat_id, turn_taken=False):
+        limited = chat_id is not None and endpoint in RATE_LIMITED_ENDPOINTS
+        for attempt in range(self.max_retries + 1):
+            if limited and not (attempt == 0 and turn_taken):
+                await self._wait_turn(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                METRICS.inc('bot_api_retry_after_total', endpoint=endpoint)
+                logger.warning(f"Bot API ответил 429 на {endpoint}, пауза {e.retry_after} сек")
+                self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + e.retry_after)
+                if not limited:
+                    await asyncio.sleep(e.retry_after)
+            except TimedOut:
+                # Повторять безопасно только идемпотентные запросы: новое сообщение могло уже уйти
+                if attempt == self.max_retries or endpoint not in IDEMPOTENT_ENDPOINTS:
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if endpoint not in MERGEABLE_ENDPOINTS or chat_id is None:
+            return await self._send(callback, args, kwargs, endpoint, chat_id)
+
+        key = (endpoint, chat_id, data.get('message_id'))
+        pending = self._pending_edits.get(key)
+        if pending is not None:
+            # Правка этого сообщения уже ждет очереди - подменяем ее содержимое на более новое
+            pending[0] = (callback, args, kwargs)
+            pending[2] += 1
+            METRICS.inc('bot_api_merged_edits_total')
+            return await asyncio.shield(pending[1])
+
+        # [последняя версия правки, общий результат, сколько правок слито в эту]
+        pending = self._pending_edits[key] = [(callback, args, kwargs), asyncio.get_running_loop().create_future(), 0]
+        future = pending[1]
+        try:
+            try:
+                if endpoint in RATE_LIMITED_ENDPOINTS:
+                    await self._wait_turn(chat_id)
+            finally:
+                # Правки, пришедшие после этого момента, уйдут отдельным запросом
+                del self._pending_edits[key]
+            callback, args, kwargs = pending[0]
+            result = await self._send(callback, args, kwargs, endpoint, chat_id, turn_taken=True)
+        except BaseException as e:
+            if pending[2]:
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+# Сборка приложения со всеми обработчиками
+def build_application(base_url=None):
+    """Создает Application; base_url позволяет направить запросы Bot API на локальную имитацию"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .rate_limiter(OutboundRateLimiter(
+            OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES
+        ))
+        # По умолчанию у HTTPXRequest одно соединение - параллельные обработчики стояли бы в очереди к Bot API
+        .connection_pool_size(min(max(UPDATE_CONCURRENCY, 8), 64))
+        .pool_timeout(10)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     # Создаем ConversationHandler
     conv_handler = ConversationHandler(
@@ -709,11 +3028,38 @@ def main():
 
     # Добавляем обработчики
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('export', export_results))
     application.add_handler(CallbackQueryHandler(handle_pagination))
+    return application
+
+def main():
+    """Запуск бота"""
+    # Telegram принимает webhook только по HTTPS; без адреса setWebhook вернул бы непонятную ошибку
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL.lower().startswith('https://'):
+        logger.error(
+            f"BOT_MODE=webhook требует WEBHOOK_URL с https:// (сейчас: '{WEBHOOK_URL}'). "
+            f"Укажите публичный HTTPS-адрес бота в .env или используйте BOT_MODE=polling"
+        )
+        sys.exit(1)
+
+    application = build_application()
 
     # Запускаем бота
-    logger.info("🚀 Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info(f"🚀 Бот запущен! Режим: {BOT_MODE}")
+    if BOT_MODE == 'webhook':
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN or None,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) == 3 and sys.argv[1] == 'login':
+        asyncio.run(login_account(sys.argv[2]))
+    else:
+        main()
@@ -24,7 +24,7 @@ source venv/bin/activate
 # Устанавливаем зависимости
 echo "📋 Устанавливаю зависимости Python..."
 pip install --upgrade pip
-pip install python-telegram-bot==20.7 telethon==1.34.0 python-dotenv==1.0.0 nest-asyncio==1.5.8 cryptg==0.4.0
+pip install 'python-telegram-bot[webhooks]==20.7' telethon==1.34.0 python-dotenv==1.0.0 cryptg==0.4.0
 
 # Создаем systemd сервис
 echo "⚙️ Создаю systemd сервис..."
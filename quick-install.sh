@@ -19,6 +19,6 @@ source venv/bin/activate
 
 # Устанавливаем Python пакеты
 pip install --upgrade pip
-pip install python-telegram-bot==20.7 telethon==1.34.0 python-dotenv==1.0.0 nest-asyncio==1.5.8 cryptg==0.4.0
+pip install 'python-telegram-bot[webhooks]==20.7' telethon==1.34.0 python-dotenv==1.0.0 cryptg==0.4.0
 
 echo "✅ Окружение готово! Теперь создайте файлы bot.py и .env"